@@ -0,0 +1,100 @@
+"""Times how long the main pages take to render, with and without
+production template mode.
+
+Usage: python development/bench_render.py [APP_COUNT [REPEAT]]
+
+This fills a throwaway SQLite database with APP_COUNT applications
+(default 200), loads what each page shows once, and then prints the
+average time to render each page's templates over REPEAT renders
+(default 200).  The two modes are interleaved so that they see the
+same conditions.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'vendor'))
+
+from webob import Request
+from directory import model
+from directory.wsgiapp import WSGIApp, Handler
+
+
+def fill_db(count):
+    session = model.Session()
+    for i in range(count):
+        origin = 'http://app%s.example.com' % i
+        manifest = dict(
+            name='App %s' % i,
+            description='Application number %s, for benchmarking' % i,
+            developer=dict(name='Developer %s' % i, url=origin),
+            icons={'64': '/icon.png'},
+            experimental=dict(keywords=['game', 'kw%s' % (i % 20)]))
+        app = model.Application.from_manifest(
+            manifest, datetime.now(), origin + '/manifest.webapp', origin,
+            session=session)
+        if i < 5:
+            app.featured = True
+    session.commit()
+
+
+def page_args(session, page_size):
+    """Returns [(name, template, args)] for the pages to render"""
+    apps = model.Application.all_apps_page(page_size, session=session)
+    results = model.Application.search_page(u'app', page_size, session=session)
+    keywords = [word for word, count in model.Keyword.all_word_counts(
+        session=session)]
+    one_app = model.Application.get('app1.example.com', session=session)
+    return [
+        ('index', 'index', dict(
+            featured_apps=model.featured_cache.get(),
+            keywords=keywords,
+            keyword_counts=dict.fromkeys(keywords, 1),
+            recent_apps=model.Application.recent(6, session=session).all())),
+        ('all apps', 'all_apps', dict(apps=apps)),
+        ('search', 'search', dict(q='app', results=results)),
+        ('keyword', 'view_keywords', dict(
+            keyword='game', description=None, apps=results)),
+        ('all keywords', 'all_keywords', dict(keywords=keywords)),
+        ('view app', 'view_app', dict(app=one_app)),
+        ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    tmp = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///' + os.path.join(tmp, 'bench.sqlite')
+        model.connect(db)
+        fill_db(count)
+        cache_dir = os.path.join(tmp, 'template-cache')
+        modes = [('development', WSGIApp(db)),
+                 ('production', WSGIApp(db, production=True,
+                                        template_cache_dir=cache_dir))]
+        session = model.Session()
+        pages = page_args(session, modes[0][1].page_size)
+        print '%-16s %14s %14s' % ('ms/render', 'development', 'production')
+        for name, template, args in pages:
+            times = {}
+            for i in range(repeat):
+                for mode, wsgi_app in modes:
+                    req = Request.blank('/')
+                    handler = Handler(wsgi_app, req, None, {})
+                    start = time.time()
+                    handler.render(template, **args)
+                    times[mode] = times.get(mode, 0) + time.time() - start
+            print '%-16s %14.3f %14.3f' % (
+                name, times['development'] / repeat * 1000,
+                times['production'] / repeat * 1000)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Measures the memory and speed of the in-memory catalog snapshot.
+
+Usage: python development/bench_snapshot.py [COUNT]
+
+This creates a temporary SQLite database with COUNT synthetic
+applications (default 100000), with keywords and a search index like
+the real ones, then loads a snapshot of it and prints the memory it
+takes per application, how long it took to load, and how long some
+page queries take.  For comparison it also loads every application
+as an ORM object.
+"""
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'vendor'))
+
+from directory import model
+from directory.snapshot import load_snapshot
+from directory.util import json, tokenize
+
+words = ('game puzzle chess music video photo news weather sports maps '
+         'travel food social chat mail office notes calendar books '
+         'comics shopping finance health fitness kids education science '
+         'space art design code tools').split()
+
+
+def memory():
+    """The resident set size of this process, in bytes"""
+    gc.collect()
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    raise OSError('No VmRSS in /proc/self/status')
+
+
+def fill(session, count, rand):
+    apps = model.Application.__table__
+    terms = model.SearchTerm.__table__
+    keywords = model.Keyword.__table__
+    session.execute(keywords.insert(), [
+        dict(word=word, description=None, hidden=False) for word in words])
+    batch = 5000
+    for start in xrange(0, count, batch):
+        app_rows = []
+        term_rows = []
+        for i in xrange(start, min(count, start + batch)):
+            name = u'%s %s %s' % (rand.choice(words).title(),
+                                  rand.choice(words).title(), i)
+            description = u' '.join(rand.choice(words) for j in range(20))
+            app_keywords = rand.sample(words, 3)
+            app_rows.append(dict(
+                id=i + 1, origin='http://app%s.example.com' % i,
+                origin_key='app%s.example.com' % i,
+                manifest_json=json.dumps(dict(name=name)),
+                manifest_url=u'http://app%s.example.com/manifest.webapp' % i,
+                name=name, slug=name.lower().replace(' ', '-'),
+                description=description,
+                icon_url=u'http://app%s.example.com/icon.png' % i,
+                developer_name=u'Developer %s' % (i % 1000),
+                keywords_denormalized=u'|%s|' % u'|'.join(app_keywords),
+                featured=i % 1000 == 0, added=model.datetime.now()))
+            weights = {}
+            for text, weight in [(name, 10), (' '.join(app_keywords), 5),
+                                 (description, 1)]:
+                for term in set(tokenize(text)):
+                    weights[term] = weights.get(term, 0) + weight
+            for term, weight in weights.items():
+                term_rows.append(dict(term=term, app_id=i + 1, weight=weight))
+        session.execute(apps.insert(), app_rows)
+        session.execute(terms.insert(), term_rows)
+    session.commit()
+
+
+def timed(func, repeat=20):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def measure_snapshot(count):
+    before = memory()
+    start = time.time()
+    snapshot = load_snapshot()
+    elapsed = time.time() - start
+    used = memory() - before
+    print 'Snapshot: %.1f MB, %.0f bytes/app, loaded in %.1f seconds' % (
+        used / 1e6, float(used) / count, elapsed)
+    page = snapshot.all_apps_page(20)
+    timings = [
+        ('get', lambda: snapshot.get('app%s.example.com' % (count // 2))),
+        ('all apps page', lambda: snapshot.all_apps_page(
+            20, after=page.next_key)),
+        ('keyword page', lambda: snapshot.search_keyword_page('chess', 20)),
+        ('search (1 word)', lambda: snapshot.search_page('chess', 20)),
+        ('search (2 words)', lambda: snapshot.search_page('chess mus', 20)),
+        ]
+    for name, func in timings:
+        print '  %-18s %8.2f ms' % (name, timed(func) * 1000)
+
+
+def measure_orm(count):
+    before = memory()
+    session = model.Session()
+    apps = session.query(model.Application).all()
+    used = memory() - before
+    print 'ORM objects: %.1f MB, %.0f bytes/app' % (
+        used / 1e6, float(used) / len(apps))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = tempfile.mkdtemp()
+    try:
+        model.connect('sqlite:///' + os.path.join(tmp, 'bench.sqlite'))
+        print 'Creating %s applications...' % count
+        fill(model.Session(), count, random.Random(0))
+        measure_snapshot(count)
+        measure_orm(count)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Times the manifest validator over a generated corpus.
+
+Usage: python development/bench_validate.py [COUNT [REPEAT]]
+
+This generates COUNT manifests (default 2000), a quarter of them with
+a few mistakes, and prints the best of REPEAT runs (default 5) of
+validating them one by one with validate(), all at once with
+validate_many(), and of formatting all the resulting error messages.
+"""
+import os
+import sys
+import random
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'vendor'))
+
+from directory.validator import validate, validate_many
+
+
+def make_manifest(i, rand):
+    manifest = dict(
+        name='App %s' % i,
+        description='Application number %s, for benchmarking' % i,
+        launch_path='/index.html',
+        version='1.%s' % i,
+        developer=dict(name='Developer %s' % i,
+                       url='http://dev%s.example.com' % i),
+        icons={'16': '/icon16.png', '64': '/icon64.png'},
+        installs_allowed_from=['*', 'http://store.example.com'],
+        experimental=dict(keywords=['game', 'kw%s' % (i % 20)]))
+    if i % 4 == 0:
+        mistakes = [
+            lambda m: m.pop('name'),
+            lambda m: m.update(launch_path='index.html'),
+            lambda m: m['icons'].update({'128': 128}),
+            lambda m: m['developer'].update(email='dev@example.com'),
+            lambda m: m.update(widget=dict(width=5)),
+            lambda m: m.update(description='x' * 2000),
+            ]
+        for mistake in rand.sample(mistakes, 3):
+            mistake(manifest)
+    return manifest
+
+
+def best_of(repeat, func):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rand = random.Random(0)
+    manifests = [make_manifest(i, rand) for i in range(count)]
+    results = validate_many(manifests)
+    errors = [error for result in results for error in result]
+    print '%s manifests, %s invalid, %s errors' % (
+        count, len([r for r in results if r]), len(errors))
+    timings = [
+        ('validate()', best_of(repeat, lambda: [validate(m) for m in manifests])),
+        ('validate_many()', best_of(repeat, lambda: validate_many(manifests))),
+        ('format errors', best_of(repeat, lambda: [unicode(e) for e in errors])),
+        ]
+    for name, elapsed in timings:
+        print '%-16s %8.2f ms  (%.1f us/manifest)' % (
+            name, elapsed * 1000, elapsed / count * 1000000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Guesses a manifest from an application's web page, for /build
+
+Only the ``<head>`` of the page is fetched and parsed: the download
+stops as soon as the parser gets to the end of it.
+"""
+import codecs
+import re
+import urlparse
+from HTMLParser import HTMLParser, HTMLParseError
+from directory import httpget
+from directory.cache import LRUCache
+
+__all__ = ['guess_manifest', 'parse_head']
+
+## Give up looking for the end of the <head> after this many bytes:
+max_head_size = 256 * 1024
+## How long a page is remembered for:
+cache_ttl = 300
+
+## {url: manifest}, so previewing the same page repeatedly is quick:
+guessed_manifests = LRUCache(max_size=200, ttl=cache_ttl)
+
+
+def guess_manifest(url, use_cache=True):
+    """Returns a manifest guessed from the page at ``url``.
+
+    Raises `httpget.FetchError` if the page can't be fetched."""
+    manifest = None
+    if use_cache:
+        manifest = guessed_manifests.get(url)
+    if manifest is None:
+        info = fetch_head(url)
+        manifest = make_manifest(info, url)
+        guessed_manifests.set(url, manifest)
+    return manifest
+
+
+def fetch_head(url):
+    """Fetches the page at ``url`` and returns what `parse_head` finds"""
+    parser = HeadParser()
+    result = httpget.fetch(url, stop=parser.feed_bytes)
+    if result.status != 200:
+        raise httpget.FetchError('%s returned %s' % (result.url, result.status))
+    if not parser.started:
+        ## Probably a canned response that didn't go through stop():
+        parser.feed_bytes(result.body)
+    charset = httpget.parse_content_type(
+        result.headers.get('content-type'))[1].get('charset')
+    return parser.finish(charset)
+
+
+def parse_head(html, charset=None):
+    """Returns a dictionary of the ``title``, ``keywords``,
+    ``description`` and ``icons`` (a list of ``(rel, sizes, href)``) in
+    the ``<head>`` of a page"""
+    parser = HeadParser()
+    parser.feed_bytes(html)
+    return parser.finish(charset)
+
+
+def make_manifest(info, url):
+    icons = {}
+    origin = urlparse.urljoin(url, '/')
+    for rel, sizes, href in info['icons']:
+        size = None
+        match = re.match(r'(\d+)x\d+', sizes or '', re.I)
+        if match:
+            size = str(match.group(1))
+        elif 'apple-touch-icon' in rel:
+            size = '57'
+        else:
+            size = '16'
+        href = urlparse.urljoin(url, href)
+        if href.startswith(origin):
+            href = '/' + href[len(origin):]
+        icons.setdefault(size, href)
+    if not icons:
+        icons['16'] = '/favicon.ico'
+    keywords = [k.strip() for k in (info['keywords'] or '').split(',')
+                if k.strip()]
+    return {
+        'name': info['title'] or 'unknown',
+        'description': (info['description'] or '')[:1024],
+        'launch_path': urlparse.urlsplit(url).path or '/',
+        'icons': icons,
+        'experimental': {'keywords': keywords},
+        }
+
+
+_meta_charset_re = re.compile(
+    r'<meta[^>]+charset\s*=\s*["\']?([a-zA-Z0-9_.:-]+)', re.I)
+
+
+class HeadParser(HTMLParser):
+    """Collects the title, meta tags and icon links from the start of
+    a page, and notices when the ``<head>`` is over"""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.started = False
+        self.done = False
+        self.size = 0
+        self.chunks = []
+        self.in_title = False
+        ## [(text, raw)], where raw text still needs decoding:
+        self.title = []
+        self.meta = {}
+        self.icons = []
+
+    def feed_bytes(self, data):
+        """Feeds raw bytes, returning true once there's no need for
+        more (the ``stop`` function for `httpget.fetch`)"""
+        self.started = True
+        if self.done:
+            return True
+        self.chunks.append(data)
+        self.size += len(data)
+        try:
+            ## Entities in attributes are decoded to unicode, so this
+            ## works on latin-1 (which can't fail) and is re-decoded
+            ## in finish():
+            self.feed(data.decode('latin-1'))
+        except HTMLParseError:
+            self.done = True
+        if self.size > max_head_size:
+            self.done = True
+        return self.done
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict((name, value or '') for name, value in attrs)
+        if tag == 'title':
+            self.in_title = True
+        elif tag == 'meta':
+            name = attrs.get('name', '').lower()
+            if name in ('keywords', 'description') and name not in self.meta:
+                self.meta[name] = attrs.get('content', '')
+        elif tag == 'link':
+            rel = attrs.get('rel', '').lower().split()
+            if 'icon' in rel or 'apple-touch-icon' in rel:
+                if attrs.get('href'):
+                    self.icons.append(
+                        (rel, attrs.get('sizes'), attrs['href']))
+        elif tag == 'body':
+            self.done = True
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title and not self.done:
+            self.title.append((data, True))
+
+    def handle_entityref(self, name):
+        if self.in_title and not self.done:
+            self.title.append((self.unescape('&%s;' % name), False))
+
+    def handle_charref(self, name):
+        if self.in_title and not self.done:
+            self.title.append((self.unescape('&#%s;' % name), False))
+
+    def finish(self, charset=None):
+        """Returns the information found, decoded with ``charset``, a
+        ``<meta>`` charset, or UTF-8"""
+        if not charset:
+            match = _meta_charset_re.search(''.join(self.chunks)[:1024])
+            if match:
+                charset = match.group(1)
+        try:
+            codecs.lookup(charset or 'utf8')
+        except LookupError:
+            charset = None
+        charset = charset or 'utf8'
+
+        def decode(text):
+            if not text:
+                return text
+            ## Undo the latin-1 decoding in feed_bytes:
+            try:
+                text = text.encode('latin-1')
+            except UnicodeEncodeError:
+                ## Has characters from entities; keep those
+                return _clean(text)
+            return _clean(text.decode(charset, 'replace'))
+
+        title = u''.join(
+            raw and text.encode('latin-1').decode(charset, 'replace') or text
+            for text, raw in self.title)
+        return dict(
+            title=_clean(title),
+            keywords=decode(self.meta.get('keywords')),
+            description=decode(self.meta.get('description')),
+            icons=[(rel, sizes, decode(href))
+                   for rel, sizes, href in self.icons])
+
+
+def _clean(text):
+    return ' '.join(text.split())
@@ -0,0 +1,122 @@
+"""In-process caches"""
+import threading
+import time
+from itertools import count
+
+__all__ = ['LRUCache', 'invalidate_app', 'app_version']
+
+
+class LRUCache(object):
+    """A bounded, thread-safe cache that forgets the least recently
+    used items first.
+
+    Keys are spread over several shards, each with its own lock, so
+    threads working on different keys rarely wait on each other.
+    Items can also expire ``ttl`` seconds after they are set."""
+
+    def __init__(self, max_size=1000, ttl=None, shards=16):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._shard_size = max(1, max_size // shards)
+        self._shards = [_Shard() for i in range(shards)]
+        ## Increases with every use, to find the least recently used:
+        self._clock = count()
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        shard.lock.acquire()
+        try:
+            entry = shard.items.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                del shard.items[key]
+                shard.evictions += 1
+                entry = None
+            if entry is None:
+                shard.misses += 1
+                return default
+            shard.hits += 1
+            entry[1] = self._clock.next()
+            return entry[0]
+        finally:
+            shard.lock.release()
+
+    def set(self, key, value):
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        shard = self._shard(key)
+        shard.lock.acquire()
+        try:
+            shard.items[key] = [value, self._clock.next(), expires]
+            if len(shard.items) > self._shard_size:
+                ## Evicting in batches keeps this cheap on average:
+                keep = self._shard_size - self._shard_size // 8
+                by_age = sorted(shard.items.items(), key=lambda i: i[1][1])
+                for old_key, entry in by_age[:len(by_age) - keep]:
+                    del shard.items[old_key]
+                    shard.evictions += 1
+        finally:
+            shard.lock.release()
+
+    def pop(self, key, default=None):
+        shard = self._shard(key)
+        shard.lock.acquire()
+        try:
+            entry = shard.items.pop(key, None)
+        finally:
+            shard.lock.release()
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        for shard in self._shards:
+            shard.lock.acquire()
+            try:
+                shard.items.clear()
+            finally:
+                shard.lock.release()
+
+    def __len__(self):
+        return sum(len(shard.items) for shard in self._shards)
+
+    def stats(self):
+        """Returns a dictionary of hits, misses, evictions and size"""
+        result = dict(size=len(self), hits=0, misses=0, evictions=0)
+        for shard in self._shards:
+            result['hits'] += shard.hits
+            result['misses'] += shard.misses
+            result['evictions'] += shard.evictions
+        return result
+
+
+class _Shard(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        ## key -> [value, last_used, expires]:
+        self.items = {}
+        self.hits = self.misses = self.evictions = 0
+
+
+## Caches of things derived from an application include the
+## application's version, which changes whenever it is invalidated:
+_app_versions = {}
+_app_versions_lock = threading.Lock()
+
+
+def invalidate_app(app_id):
+    """Makes any cached data derived from the application stale"""
+    _app_versions_lock.acquire()
+    try:
+        _app_versions[app_id] = _app_versions.get(app_id, 0) + 1
+    finally:
+        _app_versions_lock.release()
+
+
+def app_version(app_id):
+    return _app_versions.get(app_id, 0)
@@ -0,0 +1,291 @@
+"""Command-line maintenance of the directory
+
+Run ``directory COMMAND --help`` to see the options for a command."""
+import sys
+import time
+import optparse
+from directory import model
+from directory import icons
+
+__all__ = ['main']
+
+## Maps command names to functions taking (options, args):
+commands = {}
+
+
+def command(usage, name=None):
+    """Registers a function as a command, with the given usage line.
+    The command is named after the function unless ``name`` is
+    given."""
+    def decorator(func):
+        command_name = name or func.__name__.replace('_', '-')
+        func.usage = '%prog ' + command_name + ' ' + usage
+        commands[command_name] = func
+        return func
+    return decorator
+
+
+def make_parser(func):
+    parser = optparse.OptionParser(usage=func.usage, description=func.__doc__)
+    parser.add_option(
+        '--db', metavar='URL', default='sqlite:///directory.sqlite',
+        help='The database to use (default %default)')
+    parser.add_option(
+        '--icon-dir', metavar='DIR',
+        help='Mirror application icons into DIR (as icon_dir in the site config)')
+    for args, kw in getattr(func, 'options', []):
+        parser.add_option(*args, **kw)
+    return parser
+
+
+def option(*args, **kw):
+    """Adds an option to a command (use below ``@command``)"""
+    def decorator(func):
+        func.options = [(args, kw)] + getattr(func, 'options', [])
+        return func
+    return decorator
+
+
+@command('')
+def reindex(options, args):
+    """Rebuilds the search index for all applications"""
+    session = model.Session()
+    count = model.Application.rebuild_search_index(session=session)
+    session.commit()
+    print 'Indexed %s applications' % count
+
+
+@command('')
+def migrate(options, args):
+    """Brings the database schema up to date"""
+    from directory import schema
+
+    def report(version, description):
+        print 'Migrating to version %s: %s' % (version, description)
+        sys.stdout.flush()
+
+    done = schema.migrate(model.Session.bind, report=report)
+    if not done:
+        print 'The database is up to date (version %s)' % (
+            schema.latest_version)
+
+## The database can't be checked before it is migrated:
+migrate.check_schema = False
+
+
+@command('')
+def backfill(options, args):
+    """Fills in keyword associations and developer columns for all applications"""
+    session = model.Session()
+    count = model.Application.backfill(session=session)
+    session.commit()
+    print 'Updated %s applications' % count
+
+
+@command('[--dry-run]')
+@option('--dry-run', action='store_true',
+        help="Only list the keywords that would be deleted")
+def trim_keywords(options, args):
+    """Deletes keywords that no application uses"""
+    session = model.Session()
+    words = model.Keyword.trim_keywords(session=session,
+                                        dry_run=options.dry_run)
+    session.commit()
+    for word in words:
+        print word.encode('utf8')
+    if options.dry_run:
+        print 'Would delete %s keywords' % len(words)
+    else:
+        print 'Deleted %s keywords' % len(words)
+
+
+@command('[FILE]', name='import')
+@option('--threads', type='int', default=10,
+        help='How many manifests to fetch at once (default %default)')
+@option('--batch', type='int', default=50,
+        help='How many applications to save per transaction (default %default)')
+@option('-q', '--quiet', action='store_true',
+        help="Don't list the outcome for every URL")
+def import_manifests(options, args):
+    """Adds or updates applications from a list of manifest URLs
+
+    The URLs are read one per line from FILE, or from stdin if FILE
+    isn't given or is -.  Blank lines and lines starting with # are
+    ignored."""
+    from directory.importer import import_manifests
+    if not args or args[0] == '-':
+        urls = sys.stdin
+    else:
+        urls = open(args[0])
+    start = time.time()
+    counts = import_manifests(urls, threads=options.threads,
+                              batch_size=options.batch,
+                              report=make_report(options))
+    print_counts(counts, time.time() - start)
+    if counts['error']:
+        return 1
+
+
+@command('')
+@option('--threads', type='int', default=10,
+        help='How many manifests to fetch at once (default %default)')
+@option('--batch', type='int', default=50,
+        help='How many applications to save per transaction (default %default)')
+@option('--limit', type='int', metavar='N',
+        help='Only check the N least recently checked manifests')
+@option('--min-age', type='float', default=24, metavar='HOURS',
+        help="Skip manifests checked in the last HOURS hours (default %default)")
+@option('-q', '--quiet', action='store_true',
+        help="Don't list the outcome for every URL")
+def refresh(options, args):
+    """Re-fetches manifests that have not been checked recently
+
+    Fetches are conditional on the ETag and Last-Modified of the last
+    fetch, and applications are only updated when their manifest
+    changed.  Manifests that fail are retried less and less often."""
+    from datetime import timedelta
+    from directory.importer import refresh_manifests
+    start = time.time()
+    counts = refresh_manifests(
+        threads=options.threads, batch_size=options.batch,
+        limit=options.limit, min_age=timedelta(hours=options.min_age),
+        report=make_report(options))
+    print_counts(counts, time.time() - start)
+
+
+@command('--icon-dir=DIR [--force]')
+@option('--force', action='store_true',
+        help='Fetch icons again even if their URL has not changed')
+@option('--threads', type='int', default=4,
+        help='How many icons to fetch at once (default %default)')
+@option('-q', '--quiet', action='store_true',
+        help="Don't list the outcome for every icon")
+def mirror_icons(options, args):
+    """Stores local copies of application icons
+
+    Icons are mirrored as applications are added and refreshed; this
+    fills in the rest."""
+    from directory.importer import mirror_icons
+    if icons.icon_dir is None:
+        print 'You must give --icon-dir'
+        return 2
+    start = time.time()
+    counts = mirror_icons(threads=options.threads, force=options.force,
+                          report=make_report(options))
+    print_counts(counts, time.time() - start, 'icons')
+
+
+@command('[--once]')
+@option('--once', action='store_true',
+        help='Stop when there are no more submissions waiting')
+@option('--poll', type='float', default=2, metavar='SECONDS',
+        help='How often to look for new submissions (default %default)')
+@option('-q', '--quiet', action='store_true',
+        help="Don't list the outcome of every submission")
+def worker(options, args):
+    """Adds the applications submitted to /add
+
+    This is needed when the site is configured with async_add = true.
+    Several workers can run at once."""
+    from directory.importer import work
+
+    def report(job):
+        if not options.quiet:
+            line = '%-8s %s' % (job.state, job.manifest_url)
+            if job.app_url:
+                line += ' (%s)' % job.app_url
+            print line.encode('utf8')
+            sys.stdout.flush()
+
+    try:
+        work(poll_interval=options.poll, once=options.once, report=report)
+    except KeyboardInterrupt:
+        pass
+
+
+@command('[FILE]')
+@option('--batch', type='int', default=1000,
+        help='How many rows to read at a time (default %default)')
+def dump(options, args):
+    """Writes all the applications and keywords to FILE as JSON Lines
+
+    Writes to stdout if FILE isn't given or is -.  The dump can be
+    loaded into another database with "directory load"."""
+    from directory.dump import dump_catalog
+    if not args or args[0] == '-':
+        out = sys.stdout
+    else:
+        out = open(args[0], 'wb')
+    start = time.time()
+    counts = dump_catalog(out, batch_size=options.batch)
+    if out is not sys.stdout:
+        out.close()
+    print >> sys.stderr, 'Dumped %s keywords and %s applications in %.1f seconds' % (
+        counts['keywords'], counts['apps'], time.time() - start)
+
+
+@command('[FILE]')
+@option('--batch', type='int', default=500,
+        help='How many rows to save at a time (default %default)')
+def load(options, args):
+    """Adds or updates the applications and keywords in a dump
+
+    The dump (from "directory dump") is read from FILE, or stdin if
+    FILE isn't given or is -.  Nothing is saved unless the whole dump
+    loads and its checksum matches."""
+    from directory.dump import load_catalog, DumpError
+    if not args or args[0] == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args[0], 'rb')
+    start = time.time()
+    try:
+        counts = load_catalog(lines, batch_size=options.batch)
+    except DumpError, e:
+        print 'Error: %s' % e
+        return 1
+    print 'Loaded %s keywords and %s applications in %.1f seconds' % (
+        counts['keywords'], counts['apps'], time.time() - start)
+
+
+def make_report(options):
+    """Returns a function to print the outcome for each URL, unless
+    --quiet was given"""
+    def report(url, outcome, detail):
+        if not options.quiet:
+            line = '%-9s %s' % (outcome, url)
+            if detail:
+                line += ' (%s)' % detail
+            print line.encode('utf8')
+            sys.stdout.flush()
+    return report
+
+
+def print_counts(counts, elapsed, noun='manifests'):
+    total = sum(counts.values())
+    print '%s %s in %.1f seconds (%.1f/second): %s' % (
+        total, noun, elapsed, total / max(elapsed, 0.001),
+        ', '.join('%s %s' % (counts[name], name) for name in sorted(counts)))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if not args or args[0] not in commands:
+        print 'Usage: directory COMMAND [OPTIONS]'
+        print 'Commands:'
+        for name in sorted(commands):
+            print '  %-12s %s' % (name, commands[name].__doc__.splitlines()[0])
+        return 2
+    func = commands[args[0]]
+    parser = make_parser(func)
+    options, rest = parser.parse_args(args[1:])
+    model.connect(options.db,
+                  check_schema=getattr(func, 'check_schema', True))
+    if options.icon_dir:
+        icons.icon_dir = options.icon_dir
+    return func(options, rest) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
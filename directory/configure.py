@@ -8,9 +8,28 @@ __all__ = ['make_app']
 def make_app(global_conf=None, db=None, search_paths=None,
              include_static=False, debug=False,
              site_title=None, jsapi_location=None,
-             admin_htpasswd=None, admin_allow=None, admin_deny=None):
+             admin_htpasswd=None, admin_allow=None, admin_deny=None,
+             page_size=20, production=False, template_cache_dir=None,
+             async_add=False, icon_dir=None, snapshot=False,
+             replica_dbs=None, read_your_writes=10,
+             db_threads=15, db_pool_timeout=30, db_pre_ping=True,
+             sqlite_busy_timeout=5, sqlite_wal=True):
     if not db:
         db = 'sqlite:///directory.sqlite'
+    if isinstance(db_pre_ping, basestring):
+        from paste.deploy.converters import asbool
+        db_pre_ping = asbool(db_pre_ping)
+    if isinstance(sqlite_wal, basestring):
+        from paste.deploy.converters import asbool
+        sqlite_wal = asbool(sqlite_wal)
+    ## db_threads should match the threads of each server process:
+    db_options = dict(threads=int(db_threads),
+                      pool_timeout=float(db_pool_timeout),
+                      pre_ping=db_pre_ping,
+                      busy_timeout=float(sqlite_busy_timeout),
+                      wal=sqlite_wal)
+    if isinstance(replica_dbs, basestring):
+        replica_dbs = replica_dbs.split()
     if search_paths:
         if isinstance(search_paths, basestring):
             search_paths = [s.strip() for s in search_paths.splitlines()
@@ -21,8 +40,23 @@ def make_app(global_conf=None, db=None, search_paths=None,
     if isinstance(include_static, basestring):
         from paste.deploy.converters import asbool
         include_static = asbool(include_static)
+    if isinstance(production, basestring):
+        from paste.deploy.converters import asbool
+        production = asbool(production)
+    if isinstance(async_add, basestring):
+        from paste.deploy.converters import asbool
+        async_add = asbool(async_add)
+    if isinstance(snapshot, basestring):
+        from paste.deploy.converters import asbool
+        snapshot = asbool(snapshot)
     app = WSGIApp(db, search_paths, site_title=site_title,
-                  jsapi_location=jsapi_location)
+                  jsapi_location=jsapi_location, page_size=int(page_size),
+                  production=production,
+                  template_cache_dir=template_cache_dir,
+                  async_add=async_add, icon_dir=icon_dir,
+                  snapshot=snapshot, replica_dbs=replica_dbs or (),
+                  read_your_writes=int(read_your_writes),
+                  db_options=db_options)
     if include_static:
         from paste.urlparser import StaticURLParser
         from paste.urlmap import URLMap
@@ -34,6 +68,9 @@ def make_app(global_conf=None, db=None, search_paths=None,
         static_app = Cascade(static_apps)
         mapping = URLMap()
         mapping['/static'] = static_app
+        if icon_dir:
+            from directory import icons
+            mapping['/static/icons'] = icons.make_static_app(icon_dir)
         mapping[''] = app
         app = mapping
     if isinstance(debug, basestring):
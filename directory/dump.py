@@ -0,0 +1,229 @@
+"""Dumps the catalog to JSON Lines, and loads it back
+
+This is for backups, and for moving a directory between databases
+(say, from SQLite to MySQL).  The first line of a dump describes it,
+then there is a line for every keyword and every application, and
+the last line has the counts and a SHA-1 checksum of everything
+before it.  Both directions work in batches, so a dump of any size
+takes little memory.
+
+Mirrored icons aren't included; run ``directory mirror-icons`` after
+loading a dump.
+"""
+import hashlib
+from datetime import datetime
+from sqlalchemy import select
+from directory import model
+from directory.cache import invalidate_app
+from directory.util import json
+
+__all__ = ['dump_catalog', 'load_catalog', 'DumpError']
+
+format_name = 'openwebapps-directory'
+format_version = 1
+
+## The application columns that are copied as they are (the rest are
+## derived from these, or describe local icon copies):
+app_columns = [
+    'origin', 'manifest_url', 'manifest_fetched', 'manifest_json', 'name',
+    'description', 'icon_url', 'featured', 'featured_sort',
+    'featured_start', 'featured_end', 'added', 'last_updated']
+date_columns = ['manifest_fetched', 'featured_start', 'featured_end',
+                'added', 'last_updated']
+
+
+class DumpError(ValueError):
+    """Raised when a dump is incomplete, corrupted, or not a dump"""
+
+
+def dump_catalog(out, batch_size=1000, session=None):
+    """Writes all the keywords and applications to the file ``out``,
+    and returns ``{'keywords': count, 'apps': count}``"""
+    if session is None:
+        session = model.Session()
+    checksum = hashlib.sha1()
+    counts = dict(keywords=0, apps=0)
+
+    def write(record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        checksum.update(line)
+        out.write(line)
+
+    write(dict(type='header', format=format_name, version=format_version,
+               created=_format_date(datetime.now())))
+    keywords = model.Keyword.__table__
+    for row in _batches(session, keywords, keywords.c.word, batch_size):
+        write(dict(type='keyword', word=row.word,
+                   description=row.description, hidden=bool(row.hidden)))
+        counts['keywords'] += 1
+    apps = model.Application.__table__
+    for row in _batches(session, apps, apps.c.id, batch_size):
+        record = dict(type='app')
+        for name in app_columns:
+            record[name] = row[name]
+        for name in date_columns:
+            record[name] = _format_date(record[name])
+        record['featured'] = bool(record['featured'])
+        record['keywords'] = [
+            w for w in (row.keywords_denormalized or '').split('|') if w]
+        write(record)
+        counts['apps'] += 1
+    ## The trailer isn't part of the checksum:
+    out.write(json.dumps(dict(type='end', sha1=checksum.hexdigest(),
+                              **counts), sort_keys=True) + '\n')
+    return counts
+
+
+def _batches(session, table, key, batch_size):
+    """Yields all the rows of ``table`` in order of the unique column
+    ``key``, reading ``batch_size`` rows at a time"""
+    last = None
+    while True:
+        q = select([table]).order_by(key).limit(batch_size)
+        if last is not None:
+            q = q.where(key > last)
+        rows = session.execute(q).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+        last = rows[-1][key]
+
+
+def load_catalog(lines, batch_size=500, session=None):
+    """Adds or updates the keywords and applications in a dump (an
+    iterable of lines), and returns ``{'keywords': count, 'apps':
+    count}``.
+
+    Everything is loaded in one transaction, which is only committed
+    once the checksum has been checked; if anything is wrong
+    `DumpError` is raised and nothing is changed."""
+    this_session = session or model.Session()
+    checksum = hashlib.sha1()
+    counts = dict(keywords=0, apps=0)
+    trailer = None
+    batch = []
+    kind = None
+    try:
+        for number, line in enumerate(lines):
+            if trailer is not None:
+                if line.strip():
+                    raise DumpError('Data after the end of the dump (line %s)'
+                                    % (number + 1))
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('not an object')
+            except ValueError, e:
+                raise DumpError('Bad line %s: %s' % (number + 1, e))
+            record_type = record.get('type')
+            if number == 0:
+                if (record_type != 'header'
+                    or record.get('format') != format_name):
+                    raise DumpError('This is not a directory dump')
+                if record.get('version') != format_version:
+                    raise DumpError('Unknown dump version: %r'
+                                    % record.get('version'))
+            elif record_type == 'end':
+                trailer = record
+                continue
+            elif record_type in ('keyword', 'app'):
+                if record_type != kind or len(batch) >= batch_size:
+                    _load_batch(this_session, kind, batch, counts)
+                    batch = []
+                    kind = record_type
+                batch.append(record)
+            else:
+                raise DumpError('Unknown record on line %s: %r'
+                                % (number + 1, record_type))
+            checksum.update(line)
+        _load_batch(this_session, kind, batch, counts)
+        if trailer is None:
+            raise DumpError('The dump is incomplete (it has no end)')
+        if trailer.get('sha1') != checksum.hexdigest():
+            raise DumpError('The checksum does not match (got %s, expected %s)'
+                            % (checksum.hexdigest(), trailer.get('sha1')))
+        for name in counts:
+            if trailer.get(name) != counts[name]:
+                raise DumpError('Expected %s %s, but loaded %s'
+                                % (trailer.get(name), name, counts[name]))
+    except:
+        this_session.rollback()
+        raise
+    if session is None:
+        this_session.commit()
+        model.featured_cache.invalidate()
+    return counts
+
+
+def _load_batch(session, kind, batch, counts):
+    if not batch:
+        return
+    if kind == 'keyword':
+        _load_keywords(session, batch)
+        counts['keywords'] += len(batch)
+    else:
+        _load_apps(session, batch)
+        counts['apps'] += len(batch)
+    session.flush()
+    ## Nothing in the batch is needed again:
+    session.expunge_all()
+
+
+def _load_keywords(session, records):
+    Keyword = model.Keyword
+    existing = dict(
+        (k.word, k) for k in session.query(Keyword).filter(
+            Keyword.word.in_([r['word'] for r in records])))
+    for record in records:
+        keyword = existing.get(record['word'])
+        if keyword is None:
+            keyword = Keyword(record['word'])
+            session.add(keyword)
+        keyword.description = record.get('description')
+        keyword.hidden = bool(record.get('hidden'))
+
+
+def _load_apps(session, records):
+    Application = model.Application
+    existing = dict(
+        (app.origin, app) for app in session.query(Application).filter(
+            Application.origin.in_([r['origin'] for r in records])))
+    for record in records:
+        values = dict((name, record.get(name)) for name in app_columns)
+        for name in date_columns:
+            values[name] = _parse_date(values[name])
+        app = existing.get(values['origin'])
+        if app is None:
+            app = Application(
+                keywords=record.get('keywords') or [],
+                **dict((name, values[name]) for name in app_columns
+                       if name not in ('added', 'last_updated')))
+            session.add(app)
+        else:
+            for name in app_columns:
+                setattr(app, name, values[name])
+            app.keywords = record.get('keywords') or []
+            app.set_slug()
+            app.set_developer()
+            invalidate_app(app.id)
+        ## Setting these keeps them from getting the current time:
+        app.added = values['added']
+        app.last_updated = values['last_updated']
+        app.update_search_terms()
+
+
+def _format_date(value):
+    if value is None:
+        return None
+    return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _parse_date(value):
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    except (TypeError, ValueError):
+        raise DumpError('Bad date: %r' % value)
@@ -1,17 +1,242 @@
 """Simple HTTP getter
 
-With mockability!
+With mockability!  Set ``_override`` to a function taking a URL; if it
+returns ``(content_type, body)`` (or a `Result`) that is used instead
+of going to the network.
+
+Requests have connect and read timeouts and a size limit, and
+connections are kept open and reused per origin.
 """
-import urllib2
+import cgi
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+__all__ = ['get', 'fetch', 'Result', 'FetchError', 'parse_content_type']
 
 _override = None
 
+## Defaults for fetch():
+default_connect_timeout = 10
+default_read_timeout = 20
+default_max_size = 1024 * 1024
+## The whole body must arrive within this many seconds:
+deadline = 60
+max_redirects = 5
+user_agent = 'openwebapps-directory'
+
+
+class FetchError(IOError):
+    """Raised when a resource can't be fetched"""
+
+
+class Result(object):
+    """The response to a `fetch`"""
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        ## Header names are lower case:
+        self.headers = headers
+        self.body = body
+
+    @property
+    def content_type(self):
+        return self.headers.get('content-type') or 'application/octet-stream'
+
+    def __repr__(self):
+        return '<Result %s %s (%s bytes)>' % (self.status, self.url, len(self.body))
+
 
 def get(manifest_url):
+    """Fetches ``manifest_url`` and returns ``(content_type, body)``.
+
+    Raises `FetchError` for anything but a successful response."""
     if _override:
         result = _override(manifest_url)
         if result is not None:
+            if isinstance(result, Result):
+                return result.content_type, result.body
+            return result
+    result = fetch(manifest_url)
+    if result.status != 200:
+        raise FetchError('%s returned %s' % (result.url, result.status))
+    return result.content_type, result.body
+
+
+def fetch(url, headers=None, max_size=None, connect_timeout=None,
+          read_timeout=None, stop=None):
+    """Does a GET for ``url`` with the extra request ``headers``,
+    following redirects, and returns a `Result`.
+
+    Non-2xx responses (like 304 or 404) are returned, not raised;
+    network errors, timeouts, bodies over ``max_size`` bytes and too
+    many redirects raise `FetchError`.
+
+    If given, ``stop(chunk)`` is called with each piece of a
+    successful response's body as it arrives, and the rest of the
+    body is not read once it returns true."""
+    if _override:
+        result = _override(url)
+        if result is not None:
+            if not isinstance(result, Result):
+                content_type, body = result
+                result = Result(url, 200, {'content-type': content_type}, body)
             return result
-    resp = urllib2.urlopen(manifest_url)
-    content_type = resp.info().getheader('content-type') or 'application/octet-stream'
-    return content_type, resp.read()
+    for i in range(max_redirects + 1):
+        result = _fetch_one(url, headers or {},
+                            max_size or default_max_size,
+                            connect_timeout or default_connect_timeout,
+                            read_timeout or default_read_timeout, stop)
+        if result.status in (301, 302, 303, 307) and result.headers.get('location'):
+            url = urlparse.urljoin(url, result.headers['location'])
+            continue
+        return result
+    raise FetchError('Too many redirects (more than %s) fetching %s'
+                     % (max_redirects, url))
+
+
+def _fetch_one(url, headers, max_size, connect_timeout, read_timeout,
+               stop=None):
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme not in ('http', 'https'):
+        raise FetchError('Not an HTTP URL: %s' % url)
+    try:
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+    except ValueError:
+        raise FetchError('Bad port in URL: %s' % url)
+    if not parsed.hostname:
+        raise FetchError('No host in URL: %s' % url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    request_headers = {'User-Agent': user_agent,
+                       'Accept-Encoding': 'identity'}
+    request_headers.update(headers)
+    conn, reused = pool.checkout(key, connect_timeout)
+    try:
+        try:
+            resp = _request(conn, path, request_headers, read_timeout)
+        except (socket.error, httplib.HTTPException):
+            if not reused:
+                raise
+            ## An idle connection may have been closed by the server:
+            conn.close()
+            conn, reused = pool.checkout(key, connect_timeout, fresh=True)
+            resp = _request(conn, path, request_headers, read_timeout)
+        if resp.status != 200:
+            stop = None
+        body, stopped = _read_body(resp, max_size, url, stop)
+    except (socket.error, httplib.HTTPException), e:
+        conn.close()
+        raise FetchError('Error fetching %s: %s'
+                         % (url, str(e) or e.__class__.__name__))
+    except:
+        conn.close()
+        raise
+    response_headers = dict(
+        (name.lower(), value) for name, value in resp.getheaders())
+    if resp.will_close or stopped:
+        ## The rest of a stopped response is still coming
+        conn.close()
+    else:
+        pool.checkin(key, conn)
+    return Result(url, resp.status, response_headers, body)
+
+
+def _request(conn, path, headers, read_timeout):
+    if conn.sock is None:
+        conn.connect()
+    conn.sock.settimeout(read_timeout)
+    conn.request('GET', path, headers=headers)
+    return conn.getresponse()
+
+
+def _read_body(resp, max_size, url, stop=None):
+    """Returns ``(body, stopped)``"""
+    length = resp.getheader('content-length')
+    if stop is None and length and length.isdigit() and int(length) > max_size:
+        raise FetchError('%s is too large (%s bytes, limit %s)'
+                         % (url, length, max_size))
+    chunks = []
+    size = 0
+    start = time.time()
+    while True:
+        chunk = resp.read(8192)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise FetchError('%s is too large (over %s bytes)' % (url, max_size))
+        if time.time() - start > deadline:
+            raise FetchError('%s took too long (over %s seconds)' % (url, deadline))
+        chunks.append(chunk)
+        if stop is not None and stop(chunk):
+            return ''.join(chunks), True
+    return ''.join(chunks), False
+
+
+class ConnectionPool(object):
+    """Keeps idle keep-alive connections, per (scheme, host, port)"""
+
+    def __init__(self, max_idle=4, idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        ## key -> [(connection, time it became idle)]:
+        self._idle = {}
+
+    def checkout(self, key, connect_timeout, fresh=False):
+        """Returns ``(connection, reused)``"""
+        if not fresh:
+            now = time.time()
+            self._lock.acquire()
+            try:
+                idle = self._idle.get(key, [])
+                while idle:
+                    conn, since = idle.pop()
+                    if now - since < self.idle_timeout:
+                        return conn, True
+                    conn.close()
+            finally:
+                self._lock.release()
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=connect_timeout)
+        return conn, False
+
+    def checkin(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.time()))
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn, since in idle:
+                    conn.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+
+pool = ConnectionPool()
+
+
+def parse_content_type(value):
+    """Splits a Content-Type header into ``(mimetype, params)``, with
+    the mimetype in lower case"""
+    mimetype, params = cgi.parse_header(value or '')
+    return mimetype.strip().lower(), params
@@ -0,0 +1,217 @@
+"""A local mirror of application icons
+
+Icons are stored as thumbnails named after the hash of the original
+image, under `icon_dir`, and served from ``/static/icons/``.  Since a
+file's content never changes it can be cached forever.  If PIL is
+installed the thumbnails are resized PNGs; otherwise the original is
+stored once, and each thumbnail name is a link to it.
+
+Only raster images are accepted: an SVG file can hold scripts, which
+would run on this site's origin.
+"""
+import base64
+import hashlib
+import os
+import tempfile
+import urllib
+import uuid
+from cStringIO import StringIO
+from directory import httpget
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+__all__ = ['icon_dir', 'url_prefix', 'sizes', 'icon_url', 'icon_src',
+           'fetch_icon', 'make_static_app', 'IconError']
+
+## Where the icons are stored; None turns off mirroring:
+icon_dir = None
+url_prefix = '/static/icons/'
+## Thumbnail sizes, in pixels, for an application box and its own page:
+sizes = {'box': 100, 'large': 256}
+max_icon_size = 512 * 1024
+
+## File extensions for the image types we keep as they are:
+extensions = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/x-icon': 'ico',
+    'image/vnd.microsoft.icon': 'ico',
+    }
+
+## Sent with every icon file, so that a browser never treats one as a
+## page or a script:
+headers = [
+    ('X-Content-Type-Options', 'nosniff'),
+    ('Content-Security-Policy', "default-src 'none'; sandbox"),
+    ]
+
+
+class IconError(Exception):
+    """Raised when an icon can't be fetched or isn't an image"""
+
+
+def icon_path(content_hash, ext, size=None):
+    """The path of a thumbnail, relative to `icon_dir` (or of the
+    original image, without a ``size``)"""
+    if size is None:
+        return '%s/%s.%s' % (content_hash[:2], content_hash, ext)
+    return '%s/%s-%s.%s' % (content_hash[:2], content_hash, size, ext)
+
+
+def icon_url(content_hash, ext, size):
+    return url_prefix + icon_path(content_hash, ext, size)
+
+
+def icon_src(app, size='box'):
+    """The URL to show an application's icon at: our copy if we have
+    one of the current icon, otherwise the icon on the application's
+    site"""
+    if app.icon_hash and app.icon_url and app.icon_source == app.icon_url:
+        return icon_url(app.icon_hash, app.icon_type, size)
+    return app.icon_url
+
+
+def is_mirrored(content_hash, ext):
+    """True if all the thumbnails for an icon exist"""
+    return icon_dir is not None and bool(content_hash) and all(
+        os.path.exists(os.path.join(icon_dir, icon_path(content_hash, ext, size)))
+        for size in sizes)
+
+
+def fetch_icon(url, known_hash=None, known_ext=None):
+    """Fetches the icon at ``url`` (which can be a ``data:`` URL) and
+    stores its thumbnails, returning ``(content_hash, ext)``.
+
+    If the content is ``known_hash`` and its thumbnails exist they are
+    not made again.  Raises `IconError` if the icon can't be
+    fetched."""
+    content_type, body = _get(url)
+    mimetype = httpget.parse_content_type(content_type)[0]
+    if mimetype not in extensions:
+        raise IconError('%s is not an image (Content-Type: %s)'
+                        % (_short(url), content_type))
+    content_hash = hashlib.sha1(body).hexdigest()
+    if content_hash == known_hash and is_mirrored(known_hash, known_ext):
+        return known_hash, known_ext
+    ext = extensions[mimetype]
+    thumbnails = _make_thumbnails(body)
+    if thumbnails is None:
+        ## Not resized, so every size is the original:
+        _write(icon_path(content_hash, ext), body)
+        for size in sizes:
+            _link(icon_path(content_hash, ext),
+                  icon_path(content_hash, ext, size))
+        return content_hash, ext
+    for size, data in thumbnails.items():
+        _write(icon_path(content_hash, 'png', size), data)
+    return content_hash, 'png'
+
+
+def _get(url):
+    if url.startswith('data:'):
+        header, sep, data = url[5:].partition(',')
+        if not sep:
+            raise IconError('Bad data: URL')
+        params = header.split(';')
+        if 'base64' in params:
+            try:
+                data = base64.b64decode(data)
+            except TypeError, e:
+                raise IconError('Bad data: URL (%s)' % e)
+        else:
+            data = urllib.unquote(data)
+        return params[0] or 'text/plain', data
+    try:
+        result = httpget.fetch(url, max_size=max_icon_size)
+    except IOError, e:
+        raise IconError(str(e) or e.__class__.__name__)
+    if result.status != 200:
+        raise IconError('%s returned %s' % (result.url, result.status))
+    return result.content_type, result.body
+
+
+def _make_thumbnails(body):
+    """Returns ``{size: png_data}``, or None if the image can't be
+    resized (without PIL, or if PIL doesn't understand it)"""
+    if Image is None:
+        return None
+    try:
+        image = Image.open(StringIO(body))
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+    except IOError:
+        return None
+    thumbnails = {}
+    for size, pixels in sizes.items():
+        thumbnail = image.copy()
+        thumbnail.thumbnail((pixels, pixels), Image.ANTIALIAS)
+        out = StringIO()
+        thumbnail.save(out, 'PNG', optimize=True)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+
+def _write(path, data):
+    """Writes a file atomically, so it's never served half-written"""
+    filename = os.path.join(icon_dir, path)
+    if os.path.exists(filename):
+        return
+    dirname = _make_dir(filename)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, filename)
+
+
+def _link(target, path):
+    """Makes ``path`` a symbolic link to ``target`` (both relative to
+    `icon_dir`, and in the same directory)"""
+    filename = os.path.join(icon_dir, path)
+    if os.path.lexists(filename):
+        return
+    dirname = _make_dir(filename)
+    ## A name no other process will pick (mktemp's could be):
+    tmp = os.path.join(dirname, '.tmp%s' % uuid.uuid4().hex)
+    os.symlink(os.path.basename(target), tmp)
+    ## If another process made the link meanwhile, this replaces it
+    ## with the same link:
+    os.rename(tmp, filename)
+
+
+def _make_dir(filename):
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            ## Another process made it
+            pass
+    return dirname
+
+
+def make_static_app(directory):
+    """A WSGI application serving the icon files in ``directory``,
+    with `headers`, and cached forever (the files never change)"""
+    from paste.urlparser import StaticURLParser
+    static_app = StaticURLParser(directory, cache_max_age=365 * 24 * 60 * 60)
+
+    def icon_app(environ, start_response):
+        def add_headers(status, response_headers, exc_info=None):
+            return start_response(status, response_headers + headers,
+                                  exc_info)
+        return static_app(environ, add_headers)
+    return icon_app
+
+
+def _short(url):
+    if len(url) > 100:
+        return url[:100] + '...'
+    return url
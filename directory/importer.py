@@ -0,0 +1,557 @@
+"""Fetching, validating and importing manifests"""
+import codecs
+import hashlib
+import threading
+import time
+import Queue
+from datetime import datetime, timedelta
+from directory import httpget
+from directory import icons
+from directory import model
+from directory import validator
+from directory.cache import LRUCache
+from directory.util import get_origin, clean_unicode, json
+
+__all__ = ['fetch_manifest', 'save_manifest', 'import_manifests',
+           'refresh_manifests', 'mirror_icons', 'work']
+
+
+## Recently fetched manifests, so checking a manifest and then adding
+## it only fetches it once (a queued add gets the copy on its AddJob):
+## {url: (content_type, body, (manifest, raw_data, errors))}
+fetched_manifests = LRUCache(max_size=500, ttl=60)
+
+
+def fetch_manifest(manifest_url, use_cache=False):
+    """Fetches and validates the manifest at ``manifest_url``.
+
+    Returns ``(manifest, raw_data, errors)``, where ``errors`` is a
+    dictionary that is empty if the manifest is valid.  With
+    ``use_cache`` a manifest fetched in the last minute is used if
+    there is one; fetch errors are never cached."""
+    entry = None
+    if use_cache:
+        entry = fetched_manifests.get(manifest_url)
+    if entry is None:
+        try:
+            content_type, body = httpget.get(manifest_url)
+        except IOError, e:
+            return None, '', {'fetch': str(e) or e.__class__.__name__}
+        entry = (content_type, body, parse_manifest(content_type, body))
+        fetched_manifests.set(manifest_url, entry)
+    manifest, raw_data, errors = entry[2]
+    ## Callers add to the errors (see annotate_errors):
+    return manifest, raw_data, dict(errors)
+
+
+## Byte order marks, which override any declared charset:
+_boms = [
+    (codecs.BOM_UTF8, 'utf8'),
+    (codecs.BOM_UTF16_LE, 'utf_16_le'),
+    (codecs.BOM_UTF16_BE, 'utf_16_be'),
+    ]
+
+
+def parse_manifest(content_type, raw_data, errors=None):
+    """Decodes, parses and validates a fetched manifest, returning
+    ``(manifest, raw_data, errors)`` like `fetch_manifest`"""
+    if errors is None:
+        errors = {}
+    mimetype, params = httpget.parse_content_type(content_type)
+    if mimetype != validator.content_type:
+        errors['content_type'] = content_type
+        errors['content_type_wanted'] = validator.content_type
+    encoding = params.get('charset') or 'utf8'
+    for bom, bom_encoding in _boms:
+        if raw_data.startswith(bom):
+            raw_data = raw_data[len(bom):]
+            encoding = bom_encoding
+            break
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        errors['unicode'] = 'Unknown charset: %s' % encoding
+        encoding = 'utf8'
+    try:
+        raw_data = raw_data.decode(encoding)
+    except UnicodeDecodeError, e:
+        ## As text, since the errors are stored as JSON (see AddJob):
+        errors['unicode'] = unicode(e)
+        raw_data = raw_data.decode(encoding, 'replace')
+    manifest = None
+    try:
+        manifest = json.loads(raw_data.strip())
+    except Exception, e:
+        errors['json_parse'] = unicode(e)
+    else:
+        error_log = validator.validate(manifest)
+        if error_log:
+            errors['error_log'] = error_log
+    return manifest, raw_data, errors
+
+
+def describe_errors(errors):
+    """A one-line summary of the errors from `fetch_manifest`"""
+    if 'fetch' in errors:
+        return 'could not fetch: %s' % errors['fetch']
+    if 'content_type' in errors:
+        return 'bad Content-Type: %s' % errors['content_type']
+    if 'json_parse' in errors:
+        return 'bad JSON: %s' % errors['json_parse']
+    if 'error_log' in errors:
+        return '; '.join(unicode(e) for e in errors['error_log'])
+    return ', '.join(sorted(errors))
+
+
+def annotate_errors(errors, url, manifest, raw_data):
+    """Adds what's needed to show ``errors`` from `fetch_manifest` to
+    the submitter (see ``errors.txt``)"""
+    errors['url'] = url
+    errors['raw_data'] = raw_data
+    if 'error_log' in errors:
+        errors['error_log'] = [unicode(e) for e in errors['error_log']]
+    errors['manifest'] = manifest
+    extra_errors = []
+    errors = clean_unicode(errors, extra_errors.append)
+    if extra_errors:
+        errors['unicode'] = extra_errors
+    return errors
+
+
+def save_manifest(manifest, manifest_url, session):
+    """Adds or updates the application for a valid manifest, returning
+    the application.
+
+    The caller commits, and then should invalidate
+    `model.featured_cache` if the application is featured."""
+    origin = get_origin(manifest_url)
+    app = model.Application.by_origin(origin, session=session)
+    if app is None:
+        app = model.Application.from_manifest(
+            manifest, datetime.now(), manifest_url, origin,
+            session=session)
+    else:
+        app.update_from_manifest(
+            manifest, datetime.now(), manifest_url, origin,
+            session=session)
+    return app
+
+
+def import_manifests(urls, threads=10, batch_size=50, report=None):
+    """Fetches, validates and adds or updates the applications whose
+    manifests are at ``urls``.
+
+    Manifests are fetched by ``threads`` threads at once, and written
+    in one transaction per ``batch_size`` manifests.  ``report(url,
+    outcome, detail)`` is called for each URL, where ``outcome`` is
+    ``'added'``, ``'updated'``, ``'error'`` or ``'skipped'`` (when a
+    later manifest in the same batch has the same origin).  Returns a
+    dictionary counting the outcomes."""
+    counts = dict(added=0, updated=0, error=0, skipped=0)
+
+    def record(url, outcome, detail=None):
+        counts[outcome] += 1
+        if report is not None:
+            report(url, outcome, detail)
+
+    urls = (url.strip() for url in urls)
+    urls = (url for url in urls if url and not url.startswith('#'))
+    batch = []
+    for url, (manifest, errors) in _map_threaded(_fetch, urls, threads):
+        if errors:
+            record(url, 'error', describe_errors(errors))
+            continue
+        batch.append((url, manifest))
+        if len(batch) >= batch_size:
+            mirror_icons(_write_batch(batch, record), threads=threads)
+            batch = []
+    if batch:
+        mirror_icons(_write_batch(batch, record), threads=threads)
+    return counts
+
+
+def _map_threaded(func, items, threads):
+    """Calls ``func(item)`` for each of ``items`` in ``threads``
+    threads, yielding ``(item, result)`` as each finishes.
+
+    Only a few items are queued ahead of the workers, so ``items``
+    can be a long iterator."""
+    todo = Queue.Queue(threads * 2)
+    done = Queue.Queue(threads * 2)
+    for i in range(threads):
+        t = threading.Thread(target=_worker, args=(func, todo, done))
+        t.setDaemon(True)
+        t.start()
+    feeder = threading.Thread(target=_feed, args=(items, todo, threads))
+    feeder.setDaemon(True)
+    feeder.start()
+    running = threads
+    while running:
+        result = done.get()
+        if result is None:
+            running -= 1
+            continue
+        yield result
+
+
+def _feed(items, todo, threads):
+    for item in items:
+        todo.put(item)
+    ## Tell each worker to stop:
+    for i in range(threads):
+        todo.put(None)
+
+
+def _worker(func, todo, done):
+    while True:
+        item = todo.get()
+        if item is None:
+            done.put(None)
+            return
+        done.put((item, func(item)))
+
+
+def _fetch(url):
+    try:
+        manifest, raw_data, errors = fetch_manifest(url)
+    except Exception, e:
+        manifest, errors = None, {'fetch': str(e) or e.__class__.__name__}
+    return manifest, errors
+
+
+def _write_batch(batch, record):
+    """Adds or updates the applications for ``[(url, manifest)]`` in
+    one transaction, returning their ids"""
+    session = model.session_factory()
+    now = datetime.now()
+    by_origin = {}
+    for url, manifest in batch:
+        origin = get_origin(url)
+        if origin in by_origin:
+            record(by_origin[origin][0], 'skipped',
+                   'replaced by %s' % url)
+        by_origin[origin] = (url, manifest)
+    existing = dict(
+        (app.origin, app) for app in session.query(model.Application).filter(
+            model.Application.origin.in_(by_origin.keys())))
+    featured_changed = False
+    words = set()
+    outcomes = []
+    saved = []
+    try:
+        for origin, (url, manifest) in by_origin.items():
+            app = existing.get(origin)
+            if app is None:
+                app = model.Application.from_manifest(
+                    manifest, now, url, origin, session=session,
+                    add_keywords=False)
+                outcomes.append((url, 'added', app.url))
+            else:
+                app.update_from_manifest(
+                    manifest, now, url, origin, session=session,
+                    add_keywords=False)
+                featured_changed = featured_changed or app.featured
+                outcomes.append((url, 'updated', app.url))
+            words.update(app.keywords)
+            saved.append(app)
+        model.Keyword.add_words(words, session=session)
+        session.flush()
+        app_ids = [app.id for app in saved]
+        session.commit()
+    except Exception, e:
+        session.rollback()
+        for url, manifest in by_origin.values():
+            record(url, 'error', 'could not save: %s' % e)
+        return []
+    finally:
+        session.close()
+    if featured_changed:
+        model.featured_cache.invalidate()
+    for url, outcome, detail in outcomes:
+        record(url, outcome, detail)
+    return app_ids
+
+
+def refresh_manifests(threads=10, batch_size=50, limit=None,
+                      min_age=timedelta(days=1), report=None):
+    """Re-fetches the manifests of applications that haven't been
+    checked within ``min_age``, least recently checked first, and
+    applies any changes.
+
+    Requests are conditional on the validators from the last fetch,
+    and an application is only written when its manifest has really
+    changed.  Applications whose manifests can't be fetched or are
+    invalid keep their old manifest, and aren't tried again until
+    their backoff (see `model.ManifestRefresh`) is over.  ``threads``,
+    ``batch_size`` and ``report`` are as for `import_manifests`; the
+    outcomes are ``'updated'``, ``'unchanged'`` and ``'error'``."""
+    counts = dict(updated=0, unchanged=0, error=0)
+
+    def record(url, outcome, detail=None):
+        counts[outcome] += 1
+        if report is not None:
+            report(url, outcome, detail)
+
+    session = model.session_factory()
+    try:
+        stale = model.ManifestRefresh.stale(
+            datetime.now(), min_age, limit=limit, session=session)
+    finally:
+        session.close()
+    batch = []
+    for item, result in _map_threaded(_refetch, stale, threads):
+        batch.append((item, result))
+        if len(batch) >= batch_size:
+            mirror_icons(_write_refresh(batch, record), threads=threads)
+            batch = []
+    if batch:
+        mirror_icons(_write_refresh(batch, record), threads=threads)
+    return counts
+
+
+def _refetch(item):
+    """Conditionally re-fetches a manifest, returning ``(outcome,
+    detail, etag, last_modified, content_hash)`` where ``detail`` is
+    the new manifest or an error message"""
+    app_id, url, etag, last_modified, content_hash = item
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        result = httpget.fetch(url, headers=headers)
+    except Exception, e:
+        return ('error', 'could not fetch: %s' % (str(e) or e.__class__.__name__),
+                etag, last_modified, content_hash)
+    if result.status == 304:
+        return ('unchanged', None,
+                result.headers.get('etag') or etag,
+                result.headers.get('last-modified') or last_modified,
+                content_hash)
+    if result.status != 200:
+        return ('error', '%s returned %s' % (result.url, result.status),
+                etag, last_modified, content_hash)
+    etag = result.headers.get('etag')
+    last_modified = result.headers.get('last-modified')
+    new_hash = hashlib.sha1(result.body).hexdigest()
+    if new_hash == content_hash:
+        return ('unchanged', None, etag, last_modified, content_hash)
+    manifest, raw_data, errors = parse_manifest(result.content_type,
+                                                result.body)
+    if errors:
+        return ('error', describe_errors(errors),
+                etag, last_modified, content_hash)
+    return ('updated', manifest, etag, last_modified, new_hash)
+
+
+def _write_refresh(batch, record):
+    """Saves the outcomes of refetching ``[(item, result)]`` in one
+    transaction, returning the ids of the updated applications"""
+    session = model.session_factory()
+    now = datetime.now()
+    ids = [item[0] for item, result in batch]
+    states = dict(
+        (state.app_id, state) for state in session.query(
+            model.ManifestRefresh).filter(
+            model.ManifestRefresh.app_id.in_(ids)))
+    changed_ids = [item[0] for item, result in batch
+                   if result[0] == 'updated']
+    apps = {}
+    if changed_ids:
+        apps = dict(
+            (app.id, app) for app in session.query(
+                model.Application).filter(
+                model.Application.id.in_(changed_ids)))
+    existing = set(app_id for app_id, in session.query(
+        model.Application.id).filter(model.Application.id.in_(ids)))
+    featured_changed = False
+    words = set()
+    outcomes = []
+    updated_ids = []
+    try:
+        for item, result in batch:
+            app_id, url = item[:2]
+            if app_id not in existing:
+                ## Deleted since we started
+                continue
+            outcome, detail, etag, last_modified, content_hash = result
+            state = states.get(app_id)
+            if state is None:
+                state = model.ManifestRefresh(app_id)
+                session.add(state)
+            if outcome == 'error':
+                state.failed(now, detail)
+                outcomes.append((url, outcome, detail))
+                continue
+            state.succeeded(now, etag, last_modified)
+            state.content_hash = content_hash
+            if outcome == 'updated':
+                app = apps[app_id]
+                ## The bytes can change without the manifest changing:
+                if detail == app.manifest:
+                    outcome = 'unchanged'
+                else:
+                    app.update_from_manifest(
+                        detail, now, app.manifest_url, session=session,
+                        add_keywords=False)
+                    featured_changed = featured_changed or app.featured
+                    words.update(app.keywords)
+                    updated_ids.append(app_id)
+            outcomes.append((url, outcome, None))
+        if words:
+            model.Keyword.add_words(words, session=session)
+        session.commit()
+    except Exception, e:
+        session.rollback()
+        for item, result in batch:
+            record(item[1], 'error', 'could not save: %s' % e)
+        return []
+    finally:
+        session.close()
+    if featured_changed:
+        model.featured_cache.invalidate()
+    for url, outcome, detail in outcomes:
+        record(url, outcome, detail)
+    return updated_ids
+
+
+def mirror_icons(app_ids=None, threads=4, force=False, batch_size=100,
+                 report=None):
+    """Stores local copies of the icons (see `directory.icons`) of the
+    applications with ``app_ids``, or of all applications.
+
+    Icons are only fetched if their URL changed since they were last
+    mirrored (or with ``force``).  If an icon can't be fetched the
+    application keeps showing the icon on its own site.  ``report`` is
+    as for `import_manifests`, with the outcomes ``'mirrored'``,
+    ``'unchanged'`` and ``'error'``."""
+    counts = dict(mirrored=0, unchanged=0, error=0)
+
+    def record(url, outcome, detail=None):
+        counts[outcome] += 1
+        if report is not None:
+            report(url, outcome, detail)
+
+    if icons.icon_dir is None or app_ids == []:
+        return counts
+    session = model.session_factory()
+    try:
+        q = session.query(
+            model.Application.id, model.Application.icon_url,
+            model.Application.icon_source, model.Application.icon_hash,
+            model.Application.icon_type).filter(
+            model.Application.icon_url != None)
+        if app_ids is not None:
+            q = q.filter(model.Application.id.in_(app_ids))
+        todo = []
+        for row in q:
+            if (force or row.icon_source != row.icon_url
+                or not icons.is_mirrored(row.icon_hash, row.icon_type)):
+                todo.append(row)
+            else:
+                record(row.icon_url, 'unchanged')
+    finally:
+        session.close()
+    batch = []
+    for row, result in _map_threaded(_fetch_icon, todo, threads):
+        batch.append((row, result))
+        if len(batch) >= batch_size:
+            _write_icons(batch, record)
+            batch = []
+    if batch:
+        _write_icons(batch, record)
+    return counts
+
+
+def _fetch_icon(row):
+    try:
+        return icons.fetch_icon(row.icon_url, row.icon_hash, row.icon_type)
+    except Exception, e:
+        return str(e) or e.__class__.__name__
+
+
+def _write_icons(batch, record):
+    session = model.session_factory()
+    try:
+        apps = dict(
+            (app.id, app) for app in session.query(model.Application).filter(
+                model.Application.id.in_([row.id for row, result in batch])))
+        outcomes = []
+        for row, result in batch:
+            app = apps.get(row.id)
+            if app is None or app.icon_url != row.icon_url:
+                ## Deleted or changed since we started
+                continue
+            if isinstance(result, basestring):
+                outcomes.append((row.icon_url, 'error', result))
+                continue
+            content_hash, ext = result
+            if (app.icon_source, app.icon_hash, app.icon_type) == (
+                row.icon_url, content_hash, ext):
+                outcomes.append((row.icon_url, 'unchanged', None))
+                continue
+            app.icon_source = row.icon_url
+            app.icon_hash = content_hash
+            app.icon_type = ext
+            outcomes.append((row.icon_url, 'mirrored', None))
+        session.commit()
+    finally:
+        session.close()
+    for url, outcome, detail in outcomes:
+        record(url, outcome, detail)
+
+
+def run_job(job, session):
+    """Fetches and saves the manifest for a claimed `model.AddJob`,
+    recording the outcome on the job.  A manifest the submitter
+    fetched when the job was submitted isn't fetched again."""
+    url = job.manifest_url
+    app = None
+    try:
+        if job.fetched_body is not None:
+            manifest, raw_data, errors = parse_manifest(
+                job.fetched_type, job.fetched_body)
+        else:
+            manifest, raw_data, errors = fetch_manifest(url)
+        if errors:
+            job.failed(annotate_errors(errors, url, manifest, raw_data))
+        else:
+            app = save_manifest(manifest, url, session)
+            job.succeeded(app.url)
+        session.commit()
+    except Exception, e:
+        session.rollback()
+        job.failed({'url': url, 'save': str(e) or e.__class__.__name__})
+        session.commit()
+        return
+    if app is not None:
+        if app.featured:
+            model.featured_cache.invalidate()
+        mirror_icons([app.id], threads=1)
+
+
+def work(poll_interval=2, once=False, keep=timedelta(days=1), report=None):
+    """Runs queued `model.AddJob`s, checking for new ones every
+    ``poll_interval`` seconds, forever (or with ``once`` until the
+    queue is empty).
+
+    Finished jobs are deleted after ``keep``.  ``report(job)`` is
+    called after each job."""
+    while True:
+        session = model.session_factory()
+        try:
+            job = model.AddJob.claim_next(session)
+            if job is None:
+                model.AddJob.purge(datetime.now() - keep, session)
+                session.commit()
+            else:
+                run_job(job, session)
+                if report is not None:
+                    report(job)
+        finally:
+            session.close()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
@@ -1,17 +1,318 @@
 """Persistence for applications"""
-from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, UnicodeText, Unicode
-from sqlalchemy import and_, or_, not_, desc
+from sqlalchemy import Column, Integer, Float, Numeric, String, DateTime, Boolean, UnicodeText, Unicode
+from sqlalchemy import LargeBinary
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy import and_, or_, not_, desc, func, exists, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import relationship, deferred, defer, undefer
+from sqlalchemy.orm.interfaces import SessionExtension
+from sqlalchemy.orm.session import Session as BaseSession
 from sqlalchemy.orm.exc import NoResultFound
-from directory.util import make_slug, get_icon, origin_to_key, json
-from datetime import datetime
+from directory.util import make_slug, get_icon, origin_to_key, tokenize, json
+from directory.cache import invalidate_app
+from directory import icons
+from sqlalchemy.exc import DBAPIError, DisconnectionError, IntegrityError
+from sqlalchemy.interfaces import PoolListener
+from datetime import datetime, timedelta
+from itertools import chain, count
+import hashlib
+import threading
+import time
+from decimal import Decimal
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 
-Session = sessionmaker()
+class CatalogChanges(SessionExtension):
+    """Advances the catalog generation (see `CatalogState`) in the
+    same transaction as any change to applications or keywords.
+
+    The generation goes up once, as the transaction commits, so the
+    catalog state row is only locked for the end of the transaction
+    (however many times it flushes).  The applications and
+    `AppDeletion` records the transaction wrote get the new generation
+    as their ``change_seq``; since the row stays locked until the
+    commit, transactions get their numbers in the order they commit,
+    which is what the sync API (see `Application.changes`) needs."""
+
+    def after_flush(self, session, flush_context):
+        writes = _catalog_writes(session)
+        for obj in chain(session.new, session.dirty):
+            if isinstance(obj, Application):
+                writes.app_ids.add(obj.id)
+            elif isinstance(obj, AppKeyword):
+                writes.app_ids.add(obj.app_id)
+            elif isinstance(obj, AppDeletion):
+                writes.deletion_ids.add(obj.id)
+            elif not isinstance(obj, Keyword):
+                continue
+            writes.changed = True
+        for obj in session.deleted:
+            if isinstance(obj, (Application, AppKeyword, Keyword)):
+                writes.changed = True
+
+    def after_bulk_update(self, session, query, query_context, result):
+        if result.rowcount:
+            _catalog_writes(session).changed = True
+
+    def after_bulk_delete(self, session, query, query_context, result):
+        if result.rowcount:
+            _catalog_writes(session).changed = True
+
+    def before_commit(self, session):
+        ## The commit flushes after this, which would be too late:
+        session.flush()
+        writes = _catalog_writes(session)
+        if writes.changed:
+            generation = CatalogState.advance(session)
+            for cls, ids in [(Application, writes.app_ids),
+                             (AppDeletion, writes.deletion_ids)]:
+                table = cls.__table__
+                values = dict(change_seq=generation)
+                if 'last_updated' in table.c:
+                    ## Or else its onupdate would change it:
+                    values['last_updated'] = table.c.last_updated
+                ids = sorted(ids)
+                while ids:
+                    session.execute(table.update().where(
+                        table.c.id.in_(ids[:500])).values(**values))
+                    ids = ids[500:]
+        session._catalog_writes = None
+
+    def after_rollback(self, session):
+        session._catalog_writes = None
+
+
+class _CatalogWrites(object):
+    """What a session's transaction has changed in the catalog so far"""
+
+    def __init__(self):
+        self.changed = False
+        self.app_ids = set()
+        self.deletion_ids = set()
+
+
+def _catalog_writes(session):
+    writes = getattr(session, '_catalog_writes', None)
+    if writes is None:
+        writes = session._catalog_writes = _CatalogWrites()
+    return writes
+
+
+## A new session, for code that keeps its own (and closes it):
+session_factory = sessionmaker(extension=CatalogChanges())
+## The current thread's session, which queries that aren't given a
+## session share; the web site removes it at the end of each request:
+Session = scoped_session(session_factory)
 Base = declarative_base()
 
 
+class PoolCounter(PoolListener):
+    """Counts database connections taken from and returned to the
+    pools, so a leak shows up as a growing ``checked_out``"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = self.checkouts = self.checkins = 0
+
+    def connect(self, dbapi_con, con_record):
+        self._lock.acquire()
+        try:
+            self.connects += 1
+        finally:
+            self._lock.release()
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        self._lock.acquire()
+        try:
+            self.checkouts += 1
+        finally:
+            self._lock.release()
+
+    def checkin(self, dbapi_con, con_record):
+        self._lock.acquire()
+        try:
+            self.checkins += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return dict(connects=self.connects, checkouts=self.checkouts,
+                    checkins=self.checkins,
+                    checked_out=self.checkouts - self.checkins)
+
+
+pool_counter = PoolCounter()
+
+
+## The read replicas, if any (see `read_session`):
+replicas = None
+
+
+def connect(db, replica_dbs=(), check_schema=True, **options):
+    """Creates an engine for the database URL ``db`` and binds
+    `Session` to it.
+
+    With ``check_schema`` the database's schema version is checked
+    (see `directory.schema.check`), and a new database gets all the
+    tables.  ``replica_dbs`` are the URLs of read-only copies of the
+    database, which `read_session` uses.  Any other options are
+    passed to `create_engine` for every database."""
+    global replicas
+    from directory import schema
+    engine = create_engine(db, **options)
+    ## Any current session is on the old database:
+    Session.remove()
+    Session.configure(bind=engine)
+    ## Nor does what was cached from the old database apply:
+    featured_cache.invalidate()
+    if check_schema:
+        schema.check(engine)
+        CatalogState.setup(session_factory())
+    if replica_dbs:
+        replicas = Replicas([create_engine(url, **options)
+                             for url in replica_dbs])
+    else:
+        replicas = None
+    return engine
+
+
+def create_engine(db, threads=15, pool_timeout=30, pre_ping=True,
+                  busy_timeout=5, wal=True):
+    """Creates an engine for the database URL ``db``, set up for a
+    process with ``threads`` threads using the database.
+
+    For SQLite each thread gets its own connection, which waits up to
+    ``busy_timeout`` seconds for a lock, and with ``wal`` the database
+    uses write-ahead logging so that reads go on while something is
+    written.  For other databases the pool keeps a connection for
+    each thread and allows as many again for a while (a thread can
+    briefly need a second one to fill a cache), waits up to
+    ``pool_timeout`` seconds for one to be free, and with
+    ``pre_ping`` tests each connection as it is taken from the pool,
+    replacing it if the server has dropped it."""
+    import sqlalchemy
+    threads = int(threads)
+    kw = dict(listeners=[pool_counter])
+    if db.startswith('sqlite:'):
+        ## The pool is a SingletonThreadPool, which only takes a size:
+        kw['pool_size'] = threads
+        kw['connect_args'] = dict(timeout=float(busy_timeout))
+        if wal and db not in ('sqlite://', 'sqlite:///:memory:'):
+            kw['listeners'].append(SQLiteWAL())
+        return sqlalchemy.create_engine(db, **kw)
+    kw.update(pool_size=threads, max_overflow=threads,
+              pool_timeout=float(pool_timeout))
+    if db.startswith('mysql:'):
+        kw['pool_recycle'] = 3600
+    engine = sqlalchemy.create_engine(db, **kw)
+    if pre_ping:
+        engine.pool.add_listener(PrePing(engine.dialect.dbapi.Error))
+    return engine
+
+
+class SQLiteWAL(PoolListener):
+    """Puts new SQLite connections in write-ahead logging mode"""
+
+    def connect(self, dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+
+class PrePing(PoolListener):
+    """Tests connections as they are checked out of the pool, so a
+    connection the server closed (say, after MySQL's wait_timeout) is
+    replaced instead of failing a request"""
+
+    def __init__(self, error_class):
+        self.error_class = error_class
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        try:
+            cursor = dbapi_con.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except self.error_class:
+            ## The pool reconnects when it gets this:
+            raise DisconnectionError()
+
+
+def read_session():
+    """Returns a session for queries that only read, which is on a
+    replica if there are any (or else the current `Session`)"""
+    if replicas is None:
+        return Session()
+    return replicas.session()
+
+
+class Replicas(object):
+    """Read-only copies of the database, used in turn.
+
+    A replica that fails the first query of a session is skipped for
+    ``retry_after`` seconds, and that query (and the rest of the
+    session) goes to the primary database instead; if none of them
+    work, reads go to the primary database."""
+
+    def __init__(self, engines, retry_after=30):
+        self.engines = engines
+        self.retry_after = retry_after
+        self._turn = count()
+        ## {engine: time to try it again}:
+        self._down = {}
+        self.failures = 0
+
+    def session(self):
+        now = time.time()
+        start = self._turn.next()
+        for i in range(len(self.engines)):
+            engine = self.engines[(start + i) % len(self.engines)]
+            if self._down.get(engine, 0) > now:
+                continue
+            ## Connections are tested as they are taken from the pool
+            ## (see PrePing), so a failure shows up on the first query:
+            return _replica_session_factory(bind=engine, replicas=self)
+        return Session()
+
+    def failed(self, engine):
+        self._down[engine] = time.time() + self.retry_after
+        self.failures += 1
+
+    def stats(self):
+        now = time.time()
+        return dict(replicas=len(self.engines), failures=self.failures,
+                    down=len([t for t in self._down.values() if t > now]))
+
+
+class ReplicaSession(BaseSession):
+    """A session on a replica, which moves to the primary database if
+    its first query fails"""
+
+    def __init__(self, replicas=None, **kw):
+        super(ReplicaSession, self).__init__(**kw)
+        self.replicas = replicas
+        self._queried = False
+
+    def execute(self, clause, params=None, mapper=None, **kw):
+        if self._queried:
+            return super(ReplicaSession, self).execute(
+                clause, params=params, mapper=mapper, **kw)
+        try:
+            result = super(ReplicaSession, self).execute(
+                clause, params=params, mapper=mapper, **kw)
+        except DBAPIError:
+            self.rollback()
+            self.replicas.failed(self.bind)
+            self.bind = Session().bind
+            result = super(ReplicaSession, self).execute(
+                clause, params=params, mapper=mapper, **kw)
+        self._queried = True
+        return result
+
+
+_replica_session_factory = sessionmaker(class_=ReplicaSession)
+
+
 class Application(Base):
     """Represents one application in the directory"""
 
@@ -20,7 +321,9 @@ class Application(Base):
     origin = Column(String(120), nullable=False, unique=True)
     # Derivative of origin (used for lookup):
     origin_key = Column(String(120), nullable=False, unique=True)
-    manifest_json = Column(UnicodeText, nullable=False)
+    # Listings don't need the manifest, so this is only loaded when
+    # accessed (or with the undefer('manifest_json') option):
+    manifest_json = deferred(Column(UnicodeText, nullable=False))
     manifest_fetched = Column(DateTime)
     manifest_url = Column(UnicodeText)
     name = Column(UnicodeText, nullable=False)
@@ -28,14 +331,36 @@ class Application(Base):
     slug = Column(UnicodeText, nullable=False)
     description = Column(UnicodeText)
     icon_url = Column(UnicodeText)
+    # Our copy of the icon (see directory.icons), made from icon_source:
+    icon_source = Column(UnicodeText)
+    icon_hash = Column(String(40))
+    icon_type = Column(String(10))
+    # Derivatives of the manifest's developer object:
+    developer_name = Column(UnicodeText)
+    developer_url = Column(UnicodeText)
     # These are represented by |keyword1|keyword2|:
     keywords_denormalized = Column(UnicodeText)
     featured = Column(Boolean, default=False)
     featured_sort = Column(Float)
     featured_start = Column(DateTime)
     featured_end = Column(DateTime)
-    added = Column(DateTime, default=datetime.now)
-    last_updated = Column(DateTime, onupdate=datetime.now)
+    added = Column(DateTime, default=datetime.now, index=True)
+    last_updated = Column(DateTime, default=datetime.now,
+                          onupdate=datetime.now, index=True)
+    ## The catalog generation that last changed the application (see
+    ## CatalogChanges), which the sync API (see `changes`) pages on:
+    change_seq = Column(Integer, index=True)
+    search_terms = relationship('SearchTerm', cascade='all, delete-orphan')
+    keyword_links = relationship('AppKeyword', cascade='all, delete-orphan')
+    refresh_state = relationship('ManifestRefresh', uselist=False,
+                                 cascade='all')
+
+    ## How much a search term counts for, depending on where it was found:
+    search_weights = {
+        'name': 10,
+        'keywords': 5,
+        'description': 1,
+        }
 
     def __init__(self, origin, manifest_json, manifest_url, manifest_fetched,
                  name, description, icon_url, keywords=None,
@@ -57,6 +382,7 @@ class Application(Base):
         ## FIXME: there must be a way to do this more automatically?
         self.set_origin_key()
         self.set_slug()
+        self.set_developer()
 
     @property
     def keywords(self):
@@ -66,11 +392,24 @@ class Application(Base):
     @keywords.setter
     def keywords(self, words):
         assert not isinstance(words, basestring)
-        words = [w.strip().lower().replace('|', ' ')
-                 for w in words]
-        words = [w for w in words if w]
-        value = '|' + '|'.join(words) + '|'
+        unique = []
+        for w in words:
+            w = w.strip().lower().replace('|', ' ')
+            if w and w not in unique:
+                unique.append(w)
+        value = '|' + '|'.join(unique) + '|'
         self.keywords_denormalized = value
+        ## keywords_denormalized keeps the order for display, while
+        ## keyword_links is what we query on:
+        missing = set(unique)
+        for link in list(self.keyword_links):
+            if link.word in missing:
+                missing.remove(link.word)
+            else:
+                self.keyword_links.remove(link)
+        for word in unique:
+            if word in missing:
+                self.keyword_links.append(AppKeyword(word))
 
     def set_origin_key(self):
         """This sets the origin_key value based on the origin"""
@@ -79,13 +418,26 @@ class Application(Base):
     def set_slug(self):
         self.slug = make_slug(self.name)
 
+    def set_developer(self):
+        """Sets developer_name and developer_url from the manifest"""
+        dev = self.manifest_developer
+        if not isinstance(dev, dict):
+            dev = {}
+        self.developer_name = dev.get('name') or None
+        self.developer_url = dev.get('url') or None
+
     def __repr__(self):
         return '<Application %s %s>' % (
             self.id or 'unsaved', self.origin)
 
     @classmethod
     def from_manifest(cls, manifest, manifest_fetched, manifest_url, origin,
-                      session=None):
+                      session=None, add_keywords=True):
+        """Creates a new application from its manifest.
+
+        Unless ``add_keywords`` is false this also adds any new
+        keywords (bulk imports do that once for many
+        applications)."""
         obj = cls(
             origin=origin,
             manifest_json=json.dumps(manifest),
@@ -100,17 +452,20 @@ class Application(Base):
             obj.keywords = keywords
         else:
             obj.keywords = ['uncategorized']
+        obj.update_search_terms()
         if session is not None:
             session.add(obj)
-        Keyword.add_words(obj.keywords, session=session)
+        if add_keywords:
+            Keyword.add_words(obj.keywords, session=session)
         return obj
 
     def update_from_manifest(self, manifest, manifest_fetched, manifest_url,
-                             origin=None, session=None):
+                             origin=None, session=None, add_keywords=True):
         if origin is not None and not self.origin == origin:
             raise ValueError(
                 "You cannot update the origin")
-        self.manifest_json = json.dumps(manifest)
+        ## This also updates the developer columns:
+        self.manifest = manifest
         self.manifest_fetched = manifest_fetched
         self.manifest_url = manifest_url
         self.name = manifest['name']
@@ -120,28 +475,61 @@ class Application(Base):
         if keywords:
             self.keywords = keywords
         self.set_slug()
+        self.update_search_terms()
+        if self.id is not None:
+            invalidate_app(self.id)
         if session:
             session.add(self)
-        Keyword.add_words(self.keywords, session=session)
+        if add_keywords:
+            Keyword.add_words(self.keywords, session=session)
         return self
 
+    ## (manifest_json, parsed manifest), so we only parse once:
+    _manifest_cache = None
+
     @property
     def manifest(self):
-        return json.loads(self.manifest_json)
+        ## If manifest_json is reloaded or reassigned it won't be the
+        ## same object, and so it gets parsed again:
+        cache = self._manifest_cache
+        if cache is None or cache[0] is not self.manifest_json:
+            cache = self._manifest_cache = (
+                self.manifest_json, json.loads(self.manifest_json))
+        return cache[1]
 
     @manifest.setter
     def manifest(self, value):
         self.manifest_json = json.dumps(value)
+        self._manifest_cache = None
+        self.set_developer()
 
     @property
     def manifest_developer(self):
         return self.manifest.get('developer')
 
+    def icon_src(self, size='box'):
+        return icons.icon_src(self, size)
+
+    @classmethod
+    def modified(cls, origin_key, session=None):
+        """Returns ``(id, last modified time)`` for the application with
+        ``origin_key`` (or None) without loading the application"""
+        if session is None:
+            session = Session()
+        row = session.query(cls.id, cls.last_updated, cls.added).filter(
+            cls.origin_key == origin_key).first()
+        if row is None:
+            return None
+        return row[0], row[1] or row[2]
+
     @classmethod
     def get(cls, origin_key, session=None):
+        """Returns the complete application for ``origin_key``, or
+        None"""
         if session is None:
             session = Session()
-        q = session.query(cls).filter(cls.origin_key == origin_key)
+        q = session.query(cls).options(undefer('manifest_json')).filter(
+            cls.origin_key == origin_key)
         try:
             return q.one()
         except NoResultFound:
@@ -161,30 +549,156 @@ class Application(Base):
     def url(self):
         return '/app/%s/%s' % (self.origin_key, self.slug)
 
+    def update_search_terms(self):
+        """Brings this application's entries in the search index up to
+        date with its name, description and keywords.
+
+        Only the terms that actually changed are added, removed or
+        reweighted."""
+        weights = {}
+        fields = [
+            ('name', self.name),
+            ('description', self.description),
+            ('keywords', ' '.join(self.keywords)),
+            ]
+        for field, text in fields:
+            for term in set(tokenize(text)):
+                weights[term] = weights.get(term, 0) + self.search_weights[field]
+        for search_term in list(self.search_terms):
+            if search_term.term in weights:
+                search_term.weight = weights.pop(search_term.term)
+            else:
+                self.search_terms.remove(search_term)
+        for term, weight in weights.items():
+            self.search_terms.append(SearchTerm(term, weight))
+
+    @classmethod
+    def rebuild_search_index(cls, session=None):
+        """Recreates the search index for every application, returning
+        the number of applications indexed"""
+        this_session = session or Session()
+        count = 0
+        for app in this_session.query(cls):
+            app.update_search_terms()
+            count += 1
+        if session is None:
+            this_session.commit()
+        return count
+
+    @classmethod
+    def backfill(cls, session=None, batch=500):
+        """Fills in the application/keyword association and the
+        developer columns from ``keywords_denormalized`` and the
+        manifest, and ``last_updated`` from ``added``, for databases
+        created before those existed.  Returns
+        the number of applications updated."""
+        this_session = session or Session()
+        count = 0
+        last_id = 0
+        while True:
+            apps = this_session.query(cls).filter(
+                cls.id > last_id).order_by(cls.id).limit(batch).all()
+            if not apps:
+                break
+            for app in apps:
+                ## The setter syncs keyword_links:
+                app.keywords = app.keywords
+                app.set_developer()
+                last_id = app.id
+            count += len(apps)
+            this_session.flush()
+        ## Applications that were never updated had no last_updated:
+        table = cls.__table__
+        this_session.execute(table.update().where(
+            table.c.last_updated == None).values(
+            last_updated=table.c.added))
+        if session is None:
+            this_session.commit()
+        return count
+
+    @classmethod
+    def _search_query(cls, query, session):
+        """Returns ``(query, sort_keys)`` for applications matching
+        ``query`` (see `search`)"""
+        sort_keys = [(cls.name, False), (cls.id, False)]
+        terms = tokenize(query)
+        if not terms:
+            return session.query(cls).filter(cls.id == None), sort_keys
+        matches = [and_(SearchTerm.term >= term,
+                        SearchTerm.term < term + u'\uffff')
+                   for term in set(terms)]
+        scores = session.query(
+            SearchTerm.app_id.label('app_id'),
+            func.sum(SearchTerm.weight).label('score')).filter(
+            or_(*matches))
+        if len(matches) > 1:
+            ## Every word has to be found somewhere in the application:
+            for match in matches:
+                scores = scores.filter(SearchTerm.app_id.in_(
+                    session.query(SearchTerm.app_id).filter(match)))
+        scores = scores.group_by(SearchTerm.app_id).subquery()
+        q = session.query(cls).join(
+            (scores, scores.c.app_id == cls.id))
+        return q, [(scores.c.score, True)] + sort_keys
+
     @classmethod
     def search(cls, query, session=None):
-        quoted_query = '%' + query.replace('%', '%%') + '%'
+        """Returns a query of applications matching all the words in
+        ``query``, best matches first.
+
+        Each word matches any indexed term it is a prefix of; a match
+        in the name counts for more than one in the keywords, which
+        counts for more than one in the description."""
         if session is None:
             session = Session()
-        q = session.query(cls).filter(or_(
-            cls.name.ilike(quoted_query),
-            cls.description.ilike(quoted_query),
-            cls.keywords_denormalized.like(quoted_query)))
-        return q
+        q, sort_keys = cls._search_query(query, session)
+        return q.order_by(*sort_order(sort_keys))
+
+    @classmethod
+    def search_page(cls, query, page_size, after=None, before=None,
+                    session=None):
+        """Returns a `Page` of `search` results"""
+        if session is None:
+            session = Session()
+        q, sort_keys = cls._search_query(query, session)
+        return paginate(q, sort_keys, page_size, after=after, before=before)
+
+    @classmethod
+    def all_apps_page(cls, page_size, after=None, before=None,
+                      session=None):
+        """Returns a `Page` of all applications, ordered by name"""
+        if session is None:
+            session = Session()
+        return paginate(cls.box_query(session),
+                        [(cls.name, False), (cls.id, False)],
+                        page_size, after=after, before=before)
+
+    @classmethod
+    def box_query(cls, session):
+        """A query for applications that will be shown as boxes, which
+        don't show the description (and like all listings, don't use
+        the manifest)"""
+        return session.query(cls).options(defer('description'))
 
     @classmethod
     def recent(cls, count, session=None):
         if session is None:
             session = Session()
-        return session.query(cls).order_by(desc(cls.added)).limit(count)
+        return cls.box_query(session).order_by(desc(cls.added)).limit(count)
 
     @classmethod
-    def featured_apps(cls, session=None):
+    def featured_apps(cls, session=None, now=None):
+        """Returns a query of the applications featured at ``now``.
+
+        The home page gets these from `featured_cache` instead."""
         if session is None:
             session = Session()
-        now = datetime.now()
-        return session.query(cls).filter(and_(
-            cls.featured,
+        if now is None:
+            now = datetime.now()
+        ## Compared, not tested as a boolean, so ix_application_featured
+        ## is used:
+        return cls.box_query(session).filter(and_(
+            cls.featured == True,
             or_(cls.featured_start == None,
                 cls.featured_start <= now),
             or_(cls.featured_end == None,
@@ -195,19 +709,328 @@ class Application(Base):
     def search_keyword(cls, keyword, session=None):
         if session is None:
             session = Session()
-        keyword = keyword.lower()
-        keyword = keyword.replace('%', '%%').replace('|', ' ')
-        match = '%|' + keyword + '|%'
-        q = session.query(cls).filter(
-            cls.keywords_denormalized.like(match))
+        keyword = keyword.strip().lower().replace('|', ' ')
+        q = session.query(cls).join(cls.keyword_links).filter(
+            AppKeyword.word == keyword)
         return q
 
+    @classmethod
+    def search_keyword_page(cls, keyword, page_size, after=None, before=None,
+                            session=None):
+        """Returns a `Page` of the applications with the given
+        keyword, ordered by name"""
+        q = cls.search_keyword(keyword, session=session)
+        return paginate(q, [(cls.name, False), (cls.id, False)],
+                        page_size, after=after, before=before)
+
+    @classmethod
+    def changes(cls, since=None, limit=100, session=None):
+        """Returns the `Changes` (applications added or updated, and
+        `AppDeletion` records) after the key ``since``, which comes
+        from the ``next_key`` of earlier changes.  Without ``since``
+        this lists the whole catalog.
+
+        Changes are ordered by ``change_seq``, with a deletion coming
+        before an application changed in the same transaction."""
+        if session is None:
+            session = Session()
+        apps = session.query(cls).options(undefer('manifest_json'))
+        deletions = session.query(AppDeletion)
+        if since is not None:
+            seq, kind, id = decode_change_key(since)
+            ## A deletion's kind is 0, and an application's is 1:
+            if kind == 0:
+                apps = apps.filter(cls.change_seq >= seq)
+                deletions = deletions.filter(or_(
+                    AppDeletion.change_seq > seq,
+                    and_(AppDeletion.change_seq == seq,
+                         AppDeletion.id > id)))
+            else:
+                apps = apps.filter(or_(
+                    cls.change_seq > seq,
+                    and_(cls.change_seq == seq, cls.id > id)))
+                deletions = deletions.filter(AppDeletion.change_seq > seq)
+        apps = apps.order_by(cls.change_seq, cls.id).limit(limit + 1)
+        deletions = deletions.order_by(
+            AppDeletion.change_seq, AppDeletion.id).limit(limit + 1)
+        ## Anything not committed through CatalogChanges has no
+        ## change_seq, and comes first:
+        items = sorted(
+            [(app.change_seq or 0, 1, app.id, app) for app in apps]
+            + [(d.change_seq or 0, 0, d.id, d) for d in deletions])
+        more = len(items) > limit
+        items = items[:limit]
+        next_key = since
+        if items:
+            next_key = encode_change_key(*items[-1][:3])
+        return Changes(
+            apps=[item[3] for item in items if item[1] == 1],
+            deleted=[item[3] for item in items if item[1] == 0],
+            next_key=next_key, more=more)
+
+
+## For featured_apps (the featured applications, in order):
+Index('ix_application_featured', Application.__table__.c.featured,
+      Application.__table__.c.featured_sort)
+
+
+class AppKeyword(Base):
+    """Associates an application with one of its keywords"""
+
+    __tablename__ = 'application_keyword'
+    app_id = Column(Integer, ForeignKey('application.id'),
+                    primary_key=True)
+    word = Column(Unicode(100), primary_key=True, index=True)
+
+    def __init__(self, word):
+        self.word = word
+
+    def __repr__(self):
+        return '<AppKeyword %s app=%s>' % (self.word, self.app_id)
+
+
+class SearchTerm(Base):
+    """One entry in the inverted search index: a term that appears in
+    an application, weighted by where it appears"""
+
+    __tablename__ = 'search_term'
+    term = Column(Unicode(100), primary_key=True)
+    app_id = Column(Integer, ForeignKey('application.id'),
+                    primary_key=True, index=True)
+    weight = Column(Integer, nullable=False)
+
+    def __init__(self, term, weight):
+        self.term = term
+        self.weight = weight
+
+    def __repr__(self):
+        return '<SearchTerm %s app=%s weight=%s>' % (
+            self.term, self.app_id, self.weight)
+
+
+class AppDeletion(Base):
+    """Records that an application was deleted, so clients of the
+    sync API (see `Application.changes`) can remove it too"""
+
+    __tablename__ = 'application_deletion'
+    id = Column(Integer, primary_key=True)
+    origin = Column(String(120), nullable=False)
+    deleted = Column(DateTime, nullable=False, default=datetime.now,
+                     index=True)
+    ## Like Application.change_seq:
+    change_seq = Column(Integer, index=True)
+
+    def __init__(self, origin):
+        self.origin = origin
+
+    def __repr__(self):
+        return '<AppDeletion %s at %s>' % (self.origin, self.deleted)
+
+
+class ManifestRefresh(Base):
+    """What the refresh crawler knows about an application's manifest:
+    the validators and hash of the last response, and when to try
+    again after errors"""
+
+    __tablename__ = 'manifest_refresh'
+    app_id = Column(Integer, ForeignKey('application.id'), primary_key=True)
+    etag = Column(String(200))
+    last_modified = Column(String(100))
+    content_hash = Column(String(40))
+    checked = Column(DateTime, index=True)
+    failures = Column(Integer, nullable=False, default=0)
+    retry_after = Column(DateTime)
+    last_error = Column(UnicodeText)
+
+    ## Errors back off exponentially, from this up to max_backoff:
+    min_backoff = timedelta(hours=1)
+    max_backoff = timedelta(days=7)
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.failures = 0
+
+    def __repr__(self):
+        return '<ManifestRefresh app=%s checked=%s failures=%s>' % (
+            self.app_id, self.checked, self.failures)
+
+    def succeeded(self, now, etag=None, last_modified=None):
+        self.checked = now
+        self.etag = etag
+        self.last_modified = last_modified
+        self.failures = 0
+        self.retry_after = None
+        self.last_error = None
+
+    def failed(self, now, error):
+        self.checked = now
+        self.failures = (self.failures or 0) + 1
+        ## The exponent is capped first, as a timedelta can't be more
+        ## than a billion days:
+        backoff = min(self.min_backoff * 2 ** min(self.failures - 1, 20),
+                      self.max_backoff)
+        self.retry_after = now + backoff
+        self.last_error = error
+
+    @classmethod
+    def stale(cls, now, min_age, limit=None, session=None):
+        """Returns ``(app_id, manifest_url, etag, last_modified,
+        content_hash)`` for applications not checked within
+        ``min_age``, least recently checked first, skipping those
+        that are backing off after errors"""
+        if session is None:
+            session = Session()
+        checked = func.coalesce(cls.checked, Application.manifest_fetched)
+        q = session.query(
+            Application.id, Application.manifest_url,
+            cls.etag, cls.last_modified, cls.content_hash).outerjoin(
+            (cls, cls.app_id == Application.id)).filter(
+            Application.manifest_url != None).filter(
+            or_(cls.retry_after == None, cls.retry_after <= now)).filter(
+            or_(checked == None, checked <= now - min_age)).order_by(
+            checked, Application.id)
+        if limit:
+            q = q.limit(limit)
+        return q.all()
+
+
+class AddJob(Base):
+    """A submission of a manifest URL, waiting for ``directory worker``
+    to fetch it and add or update its application"""
+
+    __tablename__ = 'add_job'
+    id = Column(Integer, primary_key=True)
+    manifest_url = Column(UnicodeText, nullable=False)
+    ## pending, running, done or failed:
+    state = Column(String(20), nullable=False, default='pending', index=True)
+    ## A hash of the URL while the job is pending (and NULL after), so
+    ## there is only one pending job for each URL:
+    pending_key = Column(String(40), index=True, unique=True)
+    created = Column(DateTime, default=datetime.now)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    ## Set when done:
+    app_url = Column(UnicodeText)
+    ## Set when failed, like the errors from importer.fetch_manifest:
+    errors_json = Column(UnicodeText)
+    ## The Content-Type and body of the manifest as the submitter
+    ## checked it, if they did just before, so the worker doesn't
+    ## fetch it again:
+    fetched_type = Column(String(200))
+    fetched_body = Column(LargeBinary)
+
+    ## A job running for longer than this is assumed to have been
+    ## abandoned by a crashed worker, and is run again:
+    timeout = timedelta(minutes=10)
+
+    def __init__(self, manifest_url):
+        self.manifest_url = manifest_url
+        self.state = 'pending'
+        self.pending_key = self.url_key(manifest_url)
+        self.created = datetime.now()
+
+    @staticmethod
+    def url_key(manifest_url):
+        return hashlib.sha1(manifest_url.encode('utf8')).hexdigest()
+
+    def __repr__(self):
+        return '<AddJob %s %s %s>' % (self.id, self.state, self.manifest_url)
+
+    @property
+    def errors(self):
+        if not self.errors_json:
+            return {}
+        return json.loads(self.errors_json)
+
+    @classmethod
+    def submit(cls, manifest_url, session=None, fetched=None):
+        """Returns a pending job for ``manifest_url``, reusing one that
+        is already waiting.
+
+        ``fetched`` is ``(content_type, body)`` of the manifest, if the
+        submitter fetched it moments ago; the worker uses that rather
+        than fetching it again.
+
+        If another submission of the same URL gets in first, the
+        session is rolled back, so call this before making any other
+        changes."""
+        if session is None:
+            session = Session()
+        key = cls.url_key(manifest_url)
+        job = session.query(cls).filter(cls.pending_key == key).first()
+        if job is None:
+            job = cls(manifest_url)
+            session.add(job)
+            try:
+                session.flush()
+            except IntegrityError:
+                session.rollback()
+                job = session.query(cls).filter(
+                    cls.pending_key == key).first()
+                if job is None:
+                    ## Claimed already; this is a new submission after all:
+                    return cls.submit(manifest_url, session, fetched)
+        if fetched is not None:
+            job.fetched_type, job.fetched_body = fetched
+        session.flush()
+        return job
+
+    @classmethod
+    def claim_next(cls, session=None, now=None):
+        """Marks the oldest waiting job as running and returns it, or
+        returns None if there is nothing to do.
+
+        The claim is committed right away, and only one worker can
+        claim any job."""
+        if session is None:
+            session = Session()
+        if now is None:
+            now = datetime.now()
+        runnable = or_(cls.state == 'pending',
+                       and_(cls.state == 'running',
+                            cls.started < now - cls.timeout))
+        while True:
+            row = session.query(cls.id).filter(runnable).order_by(
+                cls.id).first()
+            if row is None:
+                return None
+            ## A plain UPDATE, so this doesn't count as a catalog
+            ## change (see CatalogChanges):
+            result = session.execute(cls.__table__.update().where(
+                and_(cls.id == row.id, runnable)).values(
+                state='running', started=now, pending_key=None))
+            session.commit()
+            if result.rowcount:
+                return session.query(cls).get(row.id)
+
+    def succeeded(self, app_url):
+        self.state = 'done'
+        self.finished = datetime.now()
+        self.app_url = app_url
+        self.errors_json = None
+        self.fetched_type = self.fetched_body = None
+
+    def failed(self, errors):
+        self.state = 'failed'
+        self.finished = datetime.now()
+        self.errors_json = json.dumps(errors)
+        self.fetched_type = self.fetched_body = None
+
+    @classmethod
+    def purge(cls, before, session=None):
+        """Deletes jobs that finished before ``before``"""
+        if session is None:
+            session = Session()
+        result = session.execute(cls.__table__.delete().where(
+            and_(cls.state.in_(['done', 'failed']), cls.finished < before)))
+        return result.rowcount
+
 
 class Keyword(Base):
     """Represents available keywords (keywords some application has used)
 
-    This doesn't map to applications, it only is used to generate the
-    list of all keywords."""
+    Applications are associated with keywords through `AppKeyword`;
+    this holds the information about the keyword itself."""
 
     __tablename__ = 'keyword'
     word = Column(Unicode(100), primary_key=True)
@@ -248,19 +1071,400 @@ class Keyword(Base):
     def all_words(cls, session=None):
         if session is None:
             session = Session()
-        return session.query(cls).filter(not_(cls.hidden)).order_by(cls.word)
+        return session.query(cls).filter(cls.hidden == False).order_by(
+            cls.word)
+
+    @classmethod
+    def all_word_counts(cls, session=None):
+        """Returns a query of ``(word, app_count)`` for all the
+        keywords that aren't hidden"""
+        if session is None:
+            session = Session()
+        return session.query(cls.word, func.count(AppKeyword.app_id)).outerjoin(
+            (AppKeyword, AppKeyword.word == cls.word)).filter(
+            cls.hidden == False).group_by(cls.word).order_by(cls.word)
 
     @classmethod
-    def trim_keywords(cls, session=None):
+    def trim_keywords(cls, session=None, dry_run=False):
+        """Deletes all the keywords that no application uses, returning
+        the deleted words.
+
+        With ``dry_run`` nothing is deleted, but the words that would be
+        are still returned."""
         this_session = session or Session()
-        unused = dict(
-            (k.word, k) for k in this_session.query(cls))
-        for app in this_session.query(Application):
-            for word in app.keywords:
-                if word in unused:
-                    del unused[word]
-        for obj in unused.values():
-            this_session.delete(obj)
+        unused = not_(exists().where(AppKeyword.word == cls.word))
+        words = [word for (word,) in this_session.query(cls.word).filter(
+            unused).order_by(cls.word)]
+        if words and not dry_run:
+            this_session.query(cls).filter(unused).delete(
+                synchronize_session='fetch')
         if session is None:
             this_session.commit()
-        return unused
+        return words
+
+
+## For all_words (the keywords that aren't hidden, in order):
+Index('ix_keyword_hidden_word', Keyword.__table__.c.hidden,
+      Keyword.__table__.c.word)
+
+
+class SchemaVersion(Base):
+    """The version of the database schema, in a single row (see
+    `directory.schema`)"""
+
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+
+    def __init__(self, version):
+        self.version = version
+
+    def __repr__(self):
+        return '<SchemaVersion %s>' % self.version
+
+
+class CatalogState(Base):
+    """Keeps a generation number for the catalog, which goes up every
+    time an application or keyword changes.
+
+    Anything derived from the catalog as a whole (like HTTP validators
+    for listing pages) can use it to tell if it is out of date."""
+
+    __tablename__ = 'catalog_state'
+    name = Column(String(50), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    changed = Column(DateTime, default=datetime.now)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<CatalogState %s generation=%s>' % (self.name, self.generation)
+
+    @classmethod
+    def setup(cls, session):
+        """Makes sure the catalog state row exists"""
+        if session.query(cls).get('catalog') is None:
+            session.add(cls('catalog'))
+            session.commit()
+        session.close()
+
+    @classmethod
+    def advance(cls, session):
+        """Advances the generation, returning the new one.  The row is
+        locked until the transaction ends."""
+        table = cls.__table__
+        session.execute(table.update().where(
+            table.c.name == 'catalog').values(
+            generation=table.c.generation + 1,
+            changed=datetime.now()))
+        return session.execute(select([table.c.generation]).where(
+            table.c.name == 'catalog')).scalar()
+
+    @classmethod
+    def current(cls, session=None):
+        """Returns ``(generation, time of the last change)``"""
+        if session is None:
+            session = Session()
+        return session.query(cls.generation, cls.changed).filter(
+            cls.name == 'catalog').one()
+
+
+class FeaturedCache(object):
+    """Keeps the list of featured applications in memory.
+
+    The featured applications only change when an application is
+    edited, or when some ``featured_start`` or ``featured_end`` time
+    passes.  So the list is kept until `invalidate` is called (after
+    a change is committed in this process), until the catalog
+    generation advances (see `CatalogState`, which is checked at most
+    every ``check_interval`` seconds, and catches changes made by
+    other processes), or until the next of those times.  A list is
+    not used for a time before the one it was worked out for.
+
+    The applications are detached from any session, and have only
+    the attributes needed for an application box loaded."""
+
+    def __init__(self, check_interval=2):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        ## (apps, computed at, expires, catalog generation):
+        self._cached = None
+        self._next_check = 0
+        self._generation = 0
+
+    def _fresh(self, cached, now):
+        ## A list computed for a later time isn't right for an earlier
+        ## one:
+        return cached is not None and cached[1] <= now < cached[2]
+
+    def get(self, now=None):
+        if now is None:
+            now = datetime.now()
+        cached = self._cached
+        if self._fresh(cached, now) and time.time() < self._next_check:
+            return cached[0]
+        self._lock.acquire()
+        try:
+            cached = self._cached
+            if self._fresh(cached, now) and time.time() < self._next_check:
+                return cached[0]
+            generation = self._generation
+            session = session_factory()
+            try:
+                catalog_generation = CatalogState.current(session)[0]
+                if (not self._fresh(cached, now)
+                    or cached[3] != catalog_generation):
+                    cached = self._compute(session, now) + (
+                        catalog_generation,)
+            finally:
+                ## This detaches the apps without expiring them:
+                session.close()
+            ## If invalidated while computing, this may already be out
+            ## of date, so we don't keep it:
+            if generation == self._generation:
+                self._cached = cached
+                self._next_check = time.time() + self.check_interval
+            return cached[0]
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        self._generation += 1
+        self._cached = None
+
+    def _compute(self, session, now):
+        apps = Application.featured_apps(session=session, now=now).all()
+        expires = [datetime.max]
+        next_start = session.query(
+            func.min(Application.featured_start)).filter(and_(
+            Application.featured == True,
+            Application.featured_start > now)).scalar()
+        if next_start is not None:
+            expires.append(next_start)
+        next_end = session.query(
+            func.min(Application.featured_end)).filter(and_(
+            Application.featured == True,
+            Application.featured_end >= now)).scalar()
+        if next_end is not None:
+            ## Applications are featured up to and including the end
+            ## time:
+            expires.append(next_end + timedelta(microseconds=1))
+        return apps, now, min(expires)
+
+
+featured_cache = FeaturedCache()
+
+
+class Catalog(object):
+    """The read-only queries the site's pages use, through
+    ``session``; `directory.snapshot.Snapshot` has the same methods"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def state(self):
+        """Returns ``(generation, time of the last change)``"""
+        return CatalogState.current(session=self.session)
+
+    def modified(self, origin_key):
+        return Application.modified(origin_key, session=self.session)
+
+    def get(self, origin_key):
+        return Application.get(origin_key, session=self.session)
+
+    def get_keyword(self, word):
+        return Keyword.get(word, session=self.session)
+
+    def recent(self, count):
+        return Application.recent(count, session=self.session).all()
+
+    def featured_apps(self, now=None):
+        ## These are cached, and kept in step with the primary:
+        return featured_cache.get(now)
+
+    def all_words(self):
+        return Keyword.all_words(session=self.session).all()
+
+    def all_word_counts(self):
+        return Keyword.all_word_counts(session=self.session).all()
+
+    def all_apps_page(self, page_size, after=None, before=None):
+        return Application.all_apps_page(
+            page_size, after=after, before=before, session=self.session)
+
+    def search_keyword_page(self, keyword, page_size, after=None,
+                            before=None):
+        return Application.search_keyword_page(
+            keyword, page_size, after=after, before=before,
+            session=self.session)
+
+    def search_page(self, query, page_size, after=None, before=None):
+        return Application.search_page(
+            query, page_size, after=after, before=before,
+            session=self.session)
+
+
+## Pagination:
+
+class Page(object):
+    """One page of items from `paginate`
+
+    ``next_key`` and ``prev_key`` are the keys to pass as ``after`` or
+    ``before`` to get the neighbouring pages, or None if there is no
+    such page."""
+
+    def __init__(self, items, next_key=None, prev_key=None):
+        self.items = items
+        self.next_key = next_key
+        self.prev_key = prev_key
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '<Page %s items next=%r prev=%r>' % (
+            len(self.items), self.next_key, self.prev_key)
+
+
+class Changes(object):
+    """Changes to the catalog, from `Application.changes`.
+
+    ``apps`` have been added or updated and ``deleted`` are
+    `AppDeletion` records; apply the deletions first.  ``next_key``
+    asks for the changes after these, and ``more`` is true if there
+    are more already."""
+
+    def __init__(self, apps, deleted, next_key, more):
+        self.apps = apps
+        self.deleted = deleted
+        self.next_key = next_key
+        self.more = more
+
+    def __repr__(self):
+        return '<Changes %s apps %s deleted next=%r more=%r>' % (
+            len(self.apps), len(self.deleted), self.next_key, self.more)
+
+
+def sort_order(sort_keys, reverse=False):
+    """Turns ``[(column, descending), ...]`` into ORDER BY clauses"""
+    order = []
+    for column, descending in sort_keys:
+        if descending != reverse:
+            order.append(desc(column))
+        else:
+            order.append(column)
+    return order
+
+
+def paginate(q, sort_keys, page_size, after=None, before=None):
+    """Returns one `Page` of the query ``q`` using keyset pagination.
+
+    ``sort_keys`` is a list of ``(column, descending)``, and must end
+    with a unique column so the order is stable.  ``after`` or
+    ``before`` are keys from a previous page; rather than an OFFSET
+    the page starts right after (or ends right before) the row the key
+    was taken from, so every page costs the same."""
+    reverse = before is not None
+    key = before if reverse else after
+    columns = [column for column, descending in sort_keys]
+    q = q.add_columns(*columns)
+    if key is not None:
+        values = decode_page_key(
+            key, [_key_kind(column) for column in columns])
+        q = q.filter(_keyset_condition(sort_keys, values, reverse))
+    rows = q.order_by(*sort_order(sort_keys, reverse)).limit(
+        page_size + 1).all()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if reverse:
+        rows.reverse()
+    items = [row[0] for row in rows]
+    next_key = prev_key = None
+    if rows:
+        first_key = encode_page_key(rows[0][1:])
+        last_key = encode_page_key(rows[-1][1:])
+        if reverse:
+            next_key = last_key
+            if more:
+                prev_key = first_key
+        else:
+            if key is not None:
+                prev_key = first_key
+            if more:
+                next_key = last_key
+    return Page(items, next_key=next_key, prev_key=prev_key)
+
+
+def _keyset_condition(sort_keys, values, reverse):
+    """Matches the rows that come after ``values`` in the given order"""
+    (column, descending), value = sort_keys[0], values[0]
+    if descending != reverse:
+        beyond = column < value
+    else:
+        beyond = column > value
+    if len(sort_keys) == 1:
+        return beyond
+    return or_(beyond, and_(
+        column == value,
+        _keyset_condition(sort_keys[1:], values[1:], reverse)))
+
+
+def encode_page_key(values):
+    ## MySQL returns SUM() as a Decimal:
+    values = [float(v) if isinstance(v, Decimal) else v for v in values]
+    return urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+## The kinds of value a page key can hold:
+TEXT = (basestring,)
+NUMBER = (int, long, float)
+
+
+def _key_kind(column):
+    if hasattr(column, '__clause_element__'):
+        column = column.__clause_element__()
+    if isinstance(column.type, (Integer, Float, Numeric)):
+        return NUMBER
+    return TEXT
+
+
+def decode_page_key(key, kinds=None):
+    """Decodes a key from `encode_page_key`.  If ``kinds`` is given
+    (`TEXT` or `NUMBER` for each sort key) the key has to have a value
+    of each kind, so nothing else gets as far as the database; a bad
+    key raises ValueError."""
+    try:
+        key = str(key)
+        values = json.loads(urlsafe_b64decode(key + '=' * (-len(key) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Bad page key: %r' % key)
+    if not isinstance(values, list):
+        raise ValueError('Bad page key: %r' % key)
+    if kinds is not None:
+        if len(values) != len(kinds):
+            raise ValueError('Bad page key: %r' % key)
+        for value, kind in zip(values, kinds):
+            ## JSON's true and false are ints to Python:
+            if not isinstance(value, kind) or isinstance(value, bool):
+                raise ValueError('Bad page key: %r' % key)
+    return values
+
+
+def encode_change_key(seq, kind, id):
+    """Encodes the position of a change in `Application.changes`
+    (``kind`` is 0 for a deletion and 1 for an application)"""
+    return encode_page_key([seq, kind, id])
+
+
+def decode_change_key(key):
+    try:
+        seq, kind, id = decode_page_key(key, [NUMBER, NUMBER, NUMBER])
+        if kind not in (0, 1) or not isinstance(seq, (int, long)) or (
+            not isinstance(id, (int, long))):
+            raise ValueError
+    except ValueError:
+        raise ValueError('Bad change key: %r' % key)
+    return seq, kind, id
@@ -0,0 +1,218 @@
+"""Versions of the database schema, and the migrations between them
+
+A new database gets all the tables as they are in `directory.model`,
+at `latest_version`.  An existing database is brought up to date by
+``directory migrate``, which runs the migrations it hasn't had, in
+order.  The site and the other commands only check the version (see
+`check`), and won't start with a database that needs migrating.
+
+To change the schema, change the model and add a migration that
+makes the same change to an existing database.  A migration has to
+work on a database that already has its change, since a table that
+an earlier migration creates is created as it is now; `add_column`
+and `add_index` only add what is missing.
+"""
+from sqlalchemy import select
+from sqlalchemy.engine.reflection import Inspector
+from directory import model
+
+__all__ = ['check', 'migrate', 'current_version', 'latest_version',
+           'SchemaError']
+
+## [(version, description, function)], in order:
+migrations = []
+
+
+class SchemaError(Exception):
+    """Raised when the database doesn't have the schema version this
+    code expects"""
+
+
+def migration(version, description):
+    """Registers a function that takes a connection as the migration
+    to ``version``"""
+    def decorator(func):
+        assert version == len(migrations) + 1, (
+            'Migration %s is out of order' % version)
+        migrations.append((version, description, func))
+        return func
+    return decorator
+
+
+def current_version(connection):
+    """The schema version of the database, or None if it has none
+    (because it is empty, or older than schema versions)"""
+    table = model.SchemaVersion.__table__
+    if not connection.dialect.has_table(connection, table.name):
+        return None
+    return connection.execute(select([table.c.version])).scalar()
+
+
+def check(engine):
+    """Makes sure the database has the schema version this code
+    expects, raising `SchemaError` if not.  An empty database gets
+    all the tables."""
+    connection = engine.connect()
+    try:
+        version = current_version(connection)
+        if version is None:
+            if _is_empty(connection):
+                _create(connection)
+                return
+            raise SchemaError(
+                'The database was created before schema versions; '
+                'run "directory migrate"')
+        if version < latest_version:
+            raise SchemaError(
+                'The database schema is version %s, but this needs version '
+                '%s; run "directory migrate"' % (version, latest_version))
+        if version > latest_version:
+            raise SchemaError(
+                'The database schema is version %s, which is newer than '
+                'this code (version %s)' % (version, latest_version))
+    finally:
+        connection.close()
+
+
+def migrate(engine, report=None):
+    """Runs the migrations the database hasn't had, each in its own
+    transaction, and returns their versions.  ``report(version,
+    description)`` is called before each one."""
+    connection = engine.connect()
+    try:
+        version = current_version(connection)
+        if version is None:
+            if _is_empty(connection):
+                _create(connection)
+                return []
+            ## Older than schema versions, so everything is run:
+            model.SchemaVersion.__table__.create(bind=connection)
+            _set_version(connection, 0)
+            version = 0
+        done = []
+        for number, description, func in migrations:
+            if number <= version:
+                continue
+            if report is not None:
+                report(number, description)
+            trans = connection.begin()
+            try:
+                func(connection)
+                _set_version(connection, number)
+            except:
+                trans.rollback()
+                raise
+            trans.commit()
+            done.append(number)
+        return done
+    finally:
+        connection.close()
+
+
+def _is_empty(connection):
+    return not connection.dialect.has_table(
+        connection, model.Application.__tablename__)
+
+
+def _create(connection):
+    trans = connection.begin()
+    try:
+        model.Base.metadata.create_all(bind=connection)
+        _set_version(connection, latest_version)
+    except:
+        trans.rollback()
+        raise
+    trans.commit()
+
+
+def _set_version(connection, version):
+    table = model.SchemaVersion.__table__
+    connection.execute(table.delete())
+    connection.execute(table.insert().values(version=version))
+
+
+def add_column(connection, table_name, column_name):
+    """Adds a column, as it is in the model, unless the table already
+    has it"""
+    table = model.Base.metadata.tables[table_name]
+    existing = [c['name'] for c in Inspector(connection).get_columns(
+        table_name)]
+    if column_name in existing:
+        return
+    column = table.c[column_name]
+    preparer = connection.dialect.identifier_preparer
+    connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        preparer.format_table(table), preparer.format_column(column),
+        column.type.compile(dialect=connection.dialect)))
+
+
+def add_index(connection, index_name):
+    """Creates an index, as it is in the model, unless it already
+    exists"""
+    for table in model.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == index_name:
+                existing = [i['name'] for i in
+                            Inspector(connection).get_indexes(table.name)]
+                if index_name not in existing:
+                    index.create(bind=connection)
+                return
+    raise KeyError('No index %s in the model' % index_name)
+
+
+## The migrations:
+
+@migration(1, 'Tables and columns added before schema versions')
+def add_early_tables(connection):
+    for name in ['application_keyword', 'search_term', 'application_deletion',
+                 'manifest_refresh', 'add_job', 'catalog_state']:
+        model.Base.metadata.tables[name].create(bind=connection,
+                                                checkfirst=True)
+    for name in ['developer_name', 'developer_url', 'icon_source',
+                 'icon_hash', 'icon_type']:
+        add_column(connection, 'application', name)
+    add_index(connection, 'ix_application_last_updated')
+
+
+@migration(2, 'Indexes for the recent, featured and keyword queries')
+def add_listing_indexes(connection):
+    add_index(connection, 'ix_application_added')
+    add_index(connection, 'ix_application_featured')
+    add_index(connection, 'ix_keyword_hidden_word')
+
+
+
+@migration(3, 'Checked manifests on queued submissions')
+def add_job_fetched(connection):
+    add_column(connection, 'add_job', 'fetched_type')
+    add_column(connection, 'add_job', 'fetched_body')
+
+
+
+@migration(4, 'One pending submission for each URL')
+def add_job_pending_key(connection):
+    add_column(connection, 'add_job', 'pending_key')
+    add_index(connection, 'ix_add_job_pending_key')
+
+
+
+@migration(5, 'Change sequence numbers for the sync API')
+def add_change_seq(connection):
+    state = model.CatalogState.__table__
+    generation = connection.execute(select([state.c.generation]).where(
+        state.c.name == 'catalog')).scalar() or 0
+    for table_name in 'application', 'application_deletion':
+        add_column(connection, table_name, 'change_seq')
+        add_index(connection, 'ix_%s_change_seq' % table_name)
+        ## Everything so far counts as one change (so sync clients
+        ## have to start again):
+        table = model.Base.metadata.tables[table_name]
+        values = dict(change_seq=generation)
+        if 'last_updated' in table.c:
+            ## Or else its onupdate would change it:
+            values['last_updated'] = table.c.last_updated
+        connection.execute(table.update().where(
+            table.c.change_seq == None).values(**values))
+
+
+latest_version = migrations[-1][0]
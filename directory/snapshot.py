@@ -0,0 +1,355 @@
+"""A read-only copy of the catalog in memory
+
+With ``snapshot = true`` the site serves its listing, search, keyword
+and application pages from a `Snapshot` of every application and
+keyword instead of querying the database.  Writes still go to the
+database; when the catalog generation (see `model.CatalogState`)
+advances a new snapshot is loaded, and swapped in once it is
+complete, so requests never see a half-loaded catalog.
+
+Applications are kept as `AppRecord` objects, without their
+manifests, and listings are kept pre-sorted, so a page is a
+couple of bisects.  Pages have the same keys as the database
+queries, so a pager link works the same in either mode.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip
+from datetime import datetime
+from sqlalchemy import select
+from directory import model
+from directory import icons
+from directory.model import Page, TEXT, NUMBER
+from directory.model import encode_page_key, decode_page_key
+from directory.util import tokenize
+
+__all__ = ['Snapshot', 'SnapshotCache', 'AppRecord', 'load_snapshot']
+
+
+class AppRecord(object):
+    """An application as shown in listings and on its own page; it
+    has the attributes the templates use, like `model.Application`"""
+
+    __slots__ = (
+        'id', 'origin', 'origin_key', 'slug', 'name', 'description',
+        'manifest_url', 'icon_url', 'icon_source', 'icon_hash', 'icon_type',
+        'developer_name', 'developer_url', 'keywords', 'featured',
+        'featured_sort', 'featured_start', 'featured_end', 'added',
+        'last_updated', 'change_seq')
+
+    def __init__(self, row, keywords):
+        for name in self.__slots__:
+            if name != 'keywords':
+                setattr(self, name, compact(row[name]))
+        self.keywords = keywords
+
+    def __repr__(self):
+        return '<AppRecord %s %s>' % (self.id, self.origin)
+
+    @property
+    def url(self):
+        return '/app/%s/%s' % (self.origin_key, self.slug)
+
+    def icon_src(self, size='box'):
+        return icons.icon_src(self, size)
+
+
+def compact(value):
+    """Returns ASCII text as a ``str``, which takes a quarter of the
+    memory of a ``unicode`` string (and works the same with
+    templates, comparisons and dictionaries)"""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
+
+
+class KeywordRecord(object):
+
+    __slots__ = ('word', 'description', 'hidden')
+
+    def __init__(self, word, description, hidden):
+        self.word = word
+        self.description = description
+        self.hidden = hidden
+
+    def __repr__(self):
+        return '<KeywordRecord %s>' % self.word
+
+
+class SortedList(object):
+    """Items in a fixed order, paged like `model.paginate`.
+
+    ``values`` are the values of the sort keys for each item (what
+    goes in a page key), and ``descending`` says which of them are
+    in descending order (which only works for numbers)."""
+
+    __slots__ = ('items', 'values', 'keys', 'descending')
+
+    def __init__(self, items, values, descending=()):
+        self.items = items
+        self.values = values
+        self.descending = descending
+        if descending:
+            self.keys = [self.sort_key(v) for v in values]
+        else:
+            self.keys = values
+
+    def sort_key(self, values):
+        if not self.descending:
+            return tuple(values)
+        return tuple(-value if descending else value
+                     for value, descending in zip(values, self.descending))
+
+    def __len__(self):
+        return len(self.items)
+
+    def page(self, page_size, after=None, before=None):
+        reverse = before is not None
+        key = before if reverse else after
+        position = None
+        if key is not None:
+            kinds = None
+            if self.values:
+                kinds = [NUMBER if isinstance(value, NUMBER) else TEXT
+                         for value in self.values[0]]
+            values = decode_page_key(key, kinds)
+            position = self.sort_key(values)
+        if reverse:
+            end = bisect_left(self.keys, position)
+            start = max(0, end - page_size)
+        else:
+            start = 0
+            if position is not None:
+                start = bisect_right(self.keys, position)
+            end = min(len(self.items), start + page_size)
+        items = self.items[start:end]
+        next_key = prev_key = None
+        if items:
+            first_key = encode_page_key(self.values[start])
+            last_key = encode_page_key(self.values[end - 1])
+            if reverse:
+                next_key = last_key
+                if start > 0:
+                    prev_key = first_key
+            else:
+                if key is not None:
+                    prev_key = first_key
+                if end < len(self.items):
+                    next_key = last_key
+        return Page(items, next_key=next_key, prev_key=prev_key)
+
+
+class Snapshot(object):
+    """The catalog at generation ``generation``, with the same methods
+    as `model.Catalog`"""
+
+    def __init__(self, generation, changed, apps, keywords, terms, postings):
+        self.generation = generation
+        self.changed = changed
+        self.loaded = datetime.now()
+        self.apps_by_key = dict((app.origin_key, app) for app in apps)
+        self.apps_by_id = dict((app.id, app) for app in apps)
+        self.keywords = dict((k.word, k) for k in keywords)
+        apps = sorted(apps, key=lambda app: (app.name, app.id))
+        names = [(app.name, app.id) for app in apps]
+        self.all_apps = SortedList(apps, names)
+        self.recent_apps = sorted(
+            apps, key=lambda app: app.added or datetime.min, reverse=True)
+        self.featured = sorted(
+            [app for app in apps if app.featured],
+            ## In the database's order, where NULL comes first:
+            key=lambda app: (app.featured_sort is not None, app.featured_sort))
+        ## Taken from the sorted list, so these are sorted too (and
+        ## share its keys):
+        by_word = {}
+        for app, name in izip(apps, names):
+            for word in app.keywords:
+                if word not in by_word:
+                    by_word[word] = ([], [])
+                by_word[word][0].append(app)
+                by_word[word][1].append(name)
+        self.keyword_apps = dict(
+            (word, SortedList(word_apps, word_names))
+            for word, (word_apps, word_names) in by_word.iteritems())
+        ## The search index: a sorted list of terms, and for each term
+        ## a pair of arrays of application ids and weights (which take
+        ## far less memory than tuples):
+        self.terms = terms
+        self.postings = postings
+
+    def __repr__(self):
+        return '<Snapshot generation=%s %s apps>' % (
+            self.generation, len(self.apps_by_key))
+
+    def state(self):
+        return self.generation, self.changed
+
+    def modified(self, origin_key):
+        app = self.apps_by_key.get(origin_key)
+        if app is None:
+            return None
+        return app.id, app.last_updated or app.added
+
+    def get(self, origin_key):
+        return self.apps_by_key.get(origin_key)
+
+    def get_keyword(self, word):
+        return self.keywords.get(word)
+
+    def recent(self, count):
+        return self.recent_apps[:count]
+
+    def featured_apps(self, now=None):
+        if now is None:
+            now = datetime.now()
+        return [app for app in self.featured
+                if (app.featured_start is None or app.featured_start <= now)
+                and (app.featured_end is None or app.featured_end >= now)]
+
+    def all_words(self):
+        return sorted([k for k in self.keywords.itervalues() if not k.hidden],
+                      key=lambda k: k.word)
+
+    def all_word_counts(self):
+        return [(k.word, len(self.keyword_apps.get(k.word, ())))
+                for k in self.all_words()]
+
+    def all_apps_page(self, page_size, after=None, before=None):
+        return self.all_apps.page(page_size, after=after, before=before)
+
+    def search_keyword_page(self, keyword, page_size, after=None,
+                            before=None):
+        keyword = keyword.strip().lower().replace('|', ' ')
+        apps = self.keyword_apps.get(keyword) or SortedList([], [])
+        return apps.page(page_size, after=after, before=before)
+
+    def search(self, query):
+        """Like `model.Application.search`, but returns a
+        `SortedList`"""
+        terms = set(tokenize(query))
+        scores = {}
+        matched = None
+        ## Each matching term counts once, even if several words match it:
+        seen = set()
+        for term in terms:
+            start = bisect_left(self.terms, term)
+            end = bisect_left(self.terms, term + u'\uffff')
+            found = set()
+            for i in xrange(start, end):
+                app_ids, weights = self.postings[i]
+                found.update(app_ids)
+                if i not in seen:
+                    for app_id, weight in izip(app_ids, weights):
+                        scores[app_id] = scores.get(app_id, 0) + weight
+                seen.add(i)
+            if matched is None:
+                matched = found
+            else:
+                matched &= found
+        results = []
+        for app_id in matched or ():
+            app = self.apps_by_id.get(app_id)
+            if app is not None:
+                results.append(((scores[app_id], app.name, app.id), app))
+        results.sort(key=lambda r: (-r[0][0], r[0][1], r[0][2]))
+        return SortedList([app for values, app in results],
+                          [values for values, app in results],
+                          descending=(True, False, False))
+
+    def search_page(self, query, page_size, after=None, before=None):
+        return self.search(query).page(page_size, after=after, before=before)
+
+
+def load_snapshot(session=None):
+    """Loads a `Snapshot` of the catalog from the database"""
+    if session is None:
+        session = model.Session()
+    ## Read first, so the snapshot is at least this new:
+    generation, changed = model.CatalogState.current(session=session)
+    table = model.Application.__table__
+    columns = [table.c[name] for name in AppRecord.__slots__
+               if name != 'keywords']
+    ## Every application has the same few keyword strings:
+    words = {}
+    apps = []
+    for row in session.execute(select(
+        columns + [table.c.keywords_denormalized])):
+        keywords = tuple(
+            words.setdefault(w, w)
+            for w in (row.keywords_denormalized or '').split('|') if w)
+        apps.append(AppRecord(row, keywords))
+    table = model.Keyword.__table__
+    keywords = [KeywordRecord(words.setdefault(row.word, row.word),
+                              row.description, bool(row.hidden))
+                for row in session.execute(select([table]))]
+    table = model.SearchTerm.__table__
+    terms = []
+    postings = []
+    for term, app_id, weight in session.execute(select(
+        [table.c.term, table.c.app_id, table.c.weight]).order_by(
+        table.c.term)):
+        if not terms or terms[-1] != term:
+            terms.append(term)
+            postings.append((array('l'), array('l')))
+        postings[-1][0].append(app_id)
+        postings[-1][1].append(weight)
+    return Snapshot(generation, changed, apps, keywords, terms, postings)
+
+
+class SnapshotCache(object):
+    """Keeps the current `Snapshot`.
+
+    The catalog generation is checked at most every
+    ``check_interval`` seconds (or on the next `get` after
+    `invalidate`), and if it has advanced a new snapshot is loaded.
+    Meanwhile other threads keep using the old one."""
+
+    def __init__(self, check_interval=2):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._next_check = 0
+        self.loads = 0
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.time() < self._next_check:
+            return snapshot
+        ## Only one thread checks; the rest use what there is:
+        if not self._lock.acquire(snapshot is None):
+            return snapshot
+        try:
+            if self._snapshot is not None and time.time() < self._next_check:
+                return self._snapshot
+            session = model.session_factory()
+            try:
+                generation, changed = model.CatalogState.current(
+                    session=session)
+                if (self._snapshot is None
+                    or generation != self._snapshot.generation):
+                    self._snapshot = load_snapshot(session)
+                    self.loads += 1
+            finally:
+                session.close()
+            self._next_check = time.time() + self.check_interval
+            return self._snapshot
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Makes the next `get` check the generation (e.g., after a
+        change in this process)"""
+        self._next_check = 0
+
+    def stats(self):
+        snapshot = self._snapshot
+        result = dict(loads=self.loads)
+        if snapshot is not None:
+            result.update(generation=snapshot.generation,
+                          apps=len(snapshot.apps_by_key))
+        return result
@@ -1,4 +1,5 @@
 import doctest
+import logging
 import os
 import sys
 import site
@@ -21,7 +22,7 @@ def main():
         flags = flags | doctest.REPORT_UDIFF
     if '-x' in sys.argv:
         flags = flags | doctest.REPORT_ONLY_FIRST_FAILURE
-    for fn in os.listdir(here):
+    for fn in sorted(os.listdir(here)):
         if fn.endswith('.txt') and fn.startswith('test_'):
             doctest.testfile(fn, optionflags=flags,
                              globs=init_app())
@@ -29,21 +30,31 @@ def main():
 
 def init_app():
     from directory.configure import make_app
-    if os.path.exists('test_directory.sqlite'):
-        os.unlink('test_directory.sqlite')
+    ## With the write-ahead log files, if any:
+    for suffix in '', '-wal', '-shm':
+        if os.path.exists('test_directory.sqlite' + suffix):
+            os.unlink('test_directory.sqlite' + suffix)
     simple_templates = os.path.join(os.path.dirname(here), 'simple-templates')
     wsgi_app = make_app(db='sqlite:///test_directory.sqlite',
                         include_static=True,
                         search_paths=[simple_templates])
     from webtest import TestApp
     app = TestApp(wsgi_app)
+    ## Nothing cached from an earlier test file applies:
+    from directory import model, importer, wsgiapp
+    model.featured_cache.invalidate()
+    importer.fetched_manifests.clear()
+    ## The database is new, but at the same URL:
+    wsgiapp.fragment_cache.clear()
     import directory.httpget
     if directory.httpget._override != getter:
         directory.httpget._override = getter
     return dict(
         wsgi_app=wsgi_app,
         app=app,
-        add_resource=add_resource)
+        add_resource=add_resource,
+        record_sql=record_sql,
+        start_server=start_server)
 
 
 _resources = {}
@@ -68,6 +79,90 @@ def add_resource(url, body, content_type=None):
         _resources[url] = (content_type, body)
 
 
+def start_server(routes):
+    """Serves ``routes`` on a local port in a background thread, and
+    returns the server.
+
+    ``routes`` maps paths to ``(status, headers, body)``, or to a
+    function taking the request handler and returning that.  The
+    server has a ``url`` attribute, and ``requests`` and
+    ``connections`` lists to see what clients did."""
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            server.connections.append(self.client_address)
+
+        def do_GET(self):
+            server.requests.append((self.path, dict(self.headers)))
+            route = routes.get(self.path)
+            if route is None:
+                route = (404, {}, 'Not found')
+            elif callable(route):
+                route = route(self)
+            status, headers, body = route
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            ## Clients hanging up early is expected in tests
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.url = 'http://127.0.0.1:%s' % server.server_address[1]
+    server.requests = []
+    server.connections = []
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+
+class SQLRecorder(logging.Handler):
+    """Records the SQL statements run by any engine until `stop` is
+    called"""
+
+    logger = logging.getLogger('sqlalchemy.engine')
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.statements = []
+        self.old_level = self.logger.level
+        self.logger.addHandler(self)
+        self.logger.setLevel(logging.INFO)
+
+    def emit(self, record):
+        ## Parameters are logged separately, with arguments:
+        if record.args:
+            return
+        statement = ' '.join(record.getMessage().split())
+        if statement.split(' ', 1)[0] in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            self.statements.append(statement)
+
+    def stop(self):
+        self.logger.removeHandler(self)
+        self.logger.setLevel(self.old_level)
+
+
+def record_sql():
+    return SQLRecorder()
+
+
 if __name__ == '__main__':
     setup_path()
     main()
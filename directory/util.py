@@ -15,12 +15,13 @@ except ImportError:
 
 __all__ = ['make_slug', 'get_icon', 'get_origin', 'origin_to_key',
            'format_description', 'clean_unicode', 'get_template_search_paths',
-           'json']
+           'tokenize', 'json']
 
 
 _repl_chars = re.compile(r"[ _]")
 _bad_chars = re.compile(r"[^a-z0-9-]")
 _rep_chars = re.compile(r"--+")
+_word_re = re.compile(r"\w+", re.UNICODE)
 
 
 def make_slug(name):
@@ -33,6 +34,16 @@ def make_slug(name):
     return name
 
 
+def tokenize(text, max_length=100):
+    """Splits free-form text into lower-case search terms.
+
+    Terms longer than ``max_length`` are truncated so they fit in the
+    search index."""
+    if not text:
+        return []
+    return [w[:max_length] for w in _word_re.findall(text.lower())]
+
+
 def get_icon(icons, origin):
     """Given a list of icons, pick out the best icon and return
     its (fully formed) URL
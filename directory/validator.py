@@ -1,163 +1,299 @@
-"""Validates the manifest files"""
+"""Validates the manifest files
+
+The rules are declared in `manifest_schema`, which is compiled once
+into a Python function.  Errors are `ValidationError` objects,
+which are only formatted into messages when they are shown.
+"""
 from directory.util import json
 
-__all__ = ['content_type', 'validate']
+__all__ = ['content_type', 'validate', 'validate_many', 'ValidationError']
 
 ## The expected content-type:
 content_type = 'application/x-web-app-manifest+json'
 
 
-def validate(manifest):
-    """Validate a manifest and returns a dictionary of error messages."""
-    errors = []
-    if 'capabilities' in manifest and not is_dict(manifest['capabilities']):
-        errors.append(
-            'capabilities property must be an object (got %s)'
-            % json.dumps(manifest['capabilities']))
-    if 'default_locale' in manifest:
-        if not is_string(manifest['default_locale']):
-            errors.append(
-                'default_locale property must be a string (got %s)'
-                % json.dumps(manifest['default_locale']))
-        elif not manifest['default_locale']:
-            errors.append(
-                'default_locale property must not be empty')
-            ## FIXME: should test that it's a valid locale
-    if 'experimental' in manifest and not is_dict(manifest['experimental']):
-        errors.append(
-            'experimental property must be an object (got %s)'
-            % json.dumps(manifest['experimental']))
-    if 'description' in manifest:
-        if not is_string(manifest['description']):
-            errors.append(
-                'description property must be a string (got %s)'
-                % json.dumps(manifest['description']))
-        elif not manifest['description']:
-            errors.append(
-                'description property, if present, must not be empty')
-        elif len(manifest['description']) > 1024:
-            errors.append(
-                'description property can only be 1024 characters long (got %s characters)'
-                % len(manifest['description']))
-    if 'developer' in manifest:
-        dev = manifest['developer']
-        if not is_dict(dev):
-            errors.append(
-                'developer property must be an object (got %s)'
-                % json.dumps(dev))
-        else:
-            if 'name' in dev and not is_string(dev['name']):
-                errors.append(
-                    'developer.name property must be a string (got %s)'
-                    % json.dumps(dev['name']))
-            if 'url' in dev and not is_string(dev['url']):
-                errors.append(
-                    'developer.url property must be a string (got %s)'
-                    % json.dumps(dev['name']))
-            extra = extra_keys(dev, ['name', 'url'])
-            if extra:
-                errors.append(
-                    'The developer object has unknown keys: %s'
-                    ', '.join(extra))
-    if 'icons' in manifest:
-        if not is_dict(manifest['icons']):
-            errors.append(
-                'The icons property must be an object (got %s)'
-                % json.dumps(manifest['icons']))
-        else:
-            for key in manifest['icons']:
-                if not is_string(manifest['icons'][key]):
-                    errors.append(
-                        'The icons.%s property must be a string (got %s)'
-                        % json.dumps(manifest['icons'][key]))
-                elif not manifest['icons'][key]:
-                    errors.append(
-                        'The icon.%s property is empty')
-    if 'installs_allowed_from' in manifest:
-        if not isinstance(manifest['installs_allowed_from'], (list, tuple)):
-            errors.append(
-                'The installs_allowed_from property must be a list (got %s)'
-                % json.dumps(manifest['installs_allowed_from']))
-        else:
-            for index, item in enumerate(manifest['installs_allowed_from']):
-                if not is_string(item):
-                    errors.append(
-                        'installs_allowed_from[%s] must be a string (got %s)'
-                        % (index, json.dumps(item)))
-                elif not is_origin_match(item):
-                    errors.append(
-                        'installs_allowed_from[%s] (%s) is not a proper host match string'
-                        % (index, json.dumps(item)))
-    if 'launch_path' in manifest:
-        if not is_string(manifest['launch_path']):
-            errors.append(
-                'launch_path property must be a string (got %s)'
-                % json.dumps(manifest['launch_path']))
-        elif not is_path(manifest['launch_path']):
-            errors.append(
-                'launch_path property is not a proper path (got %s)'
-                % json.dumps(manifest['launch_path']))
-    if 'name' in manifest:
-        if not is_string(manifest['name']):
-            errors.append(
-                'name property must be a string (got %s)'
-                % json.dumps(manifest['name']))
-        elif not manifest['name']:
-            errors.append(
-                'name property must not be empty')
-    else:
-        errors.append(
-            'The name property is required and was not provided')
-    if 'version' in manifest and not is_string(manifest['version']):
-        errors.append(
-            'The version property must be a string (got %s)'
-            % json.dumps(manifest['version']))
-    if 'widget' in manifest:
-        wid = manifest['widget']
-        if not is_dict(wid):
-            errors.append(
-                'The widget property must be an object (got %s)'
-                % json.dumps(wid))
-        if 'path' not in wid:
-            errors.append(
-                'The widget.path property is missing')
-        elif not is_string(wid['path']):
-            errors.append(
-                'The widget.path property must be a string (got %s)'
-                % json.dumps(wid['path']))
-        elif not is_path(wid['path']):
-            errors.append(
-                'The widget.path property is not a valid path (got %s)'
-                % json.dumps(wid['path']))
-        if 'width' in wid:
-            if not isinstance(wid['width'], int):
-                errors.append(
-                    'The widget.width property must be an integer (got %s)'
-                    % json.dumps(wid['width']))
-            elif 10 > wid['width'] > 1000:
-                errors.append(
-                    'The widget.width property must be [10-1000]')
-        if 'height' in wid:
-            if not isinstance(wid['height'], int):
-                errors.append(
-                    'The widget.height property must be an integer (got %s)'
-                    % json.dumps(wid['height']))
-            elif 10 > wid['height'] > 1000:
-                errors.append(
-                    'The widget.height property must be [10-1000]')
+class ValidationError(object):
+    """A problem with one value in a manifest.
 
-    return errors
+    ``path`` is the location of the value, like ``('icons', '16')``.
+    The message is formatted (and the value serialized) only when the
+    error is converted to a string, and compares equal to that
+    string."""
 
+    __slots__ = ('template', 'path', 'value', 'params')
 
-## A bunch of helpers:
+    def __init__(self, template, path, value, **params):
+        self.template = template
+        self.path = path
+        self.value = value
+        self.params = params
+
+    @property
+    def name(self):
+        """The path as a string, like ``icons.16`` or
+        ``installs_allowed_from[0]``"""
+        name = ''
+        for item in self.path:
+            if isinstance(item, (int, long)):
+                name += '[%s]' % item
+            elif name:
+                name += '.' + item
+            else:
+                name = item
+        return name
+
+    def __unicode__(self):
+        params = dict(self.params, name=self.name)
+        if '%(got)s' in self.template:
+            params['got'] = json.dumps(self.value)
+        return unicode(self.template) % params
+
+    def __str__(self):
+        return unicode(self).encode('utf8')
+
+    def __repr__(self):
+        return '<ValidationError %s>' % self
+
+    def __eq__(self, other):
+        if isinstance(other, ValidationError):
+            other = unicode(other)
+        return unicode(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+## Messages:
+REQUIRED = 'The %(name)s property is required and was not provided'
+WRONG_TYPE = '%(name)s property must be %(kind)s (got %(got)s)'
+EMPTY = '%(name)s property must not be empty'
+TOO_LONG = ('%(name)s property can only be %(max_length)s characters long '
+            '(got %(length)s characters)')
+OUT_OF_RANGE = ('%(name)s property must be between %(min)s and %(max)s '
+                '(got %(got)s)')
+EXTRA_KEYS = 'The %(name)s object has unknown keys: %(keys)s'
+NOT_A_PATH = '%(name)s property is not a proper path (got %(got)s)'
+NOT_AN_ORIGIN_MATCH = '%(name)s (%(got)s) is not a proper host match string'
+NOT_AN_OBJECT = 'The manifest must be an object (got %(got)s)'
+
+## Some properties have always had their own wording for the messages
+## above, which clients of /add may be matching, so rules can be given
+## these instead (see Rule.message):
+THE_WRONG_TYPE = 'The %(name)s property must be %(kind)s (got %(got)s)'
+ITEM_WRONG_TYPE = '%(name)s must be %(kind)s (got %(got)s)'
+EMPTY_IF_PRESENT = '%(name)s property, if present, must not be empty'
+IS_EMPTY = 'The %(name)s property is empty'
+MISSING = 'The %(name)s property is missing'
+NOT_A_VALID_PATH = 'The %(name)s property is not a valid path (got %(got)s)'
+NOT_IN_RANGE = 'The %(name)s property must be [%(min)s-%(max)s]'
+
+
+## The rules.  Rather than walking the rules for every manifest,
+## compile() generates the Python code that checks a value against a
+## rule (see _Compiler), so checking a manifest runs straight-line code
+## much like a hand-written validator.  Paths are only built for
+## errors.
+
+class Rule(object):
+    """``messages`` maps the standard messages to the ones to use
+    instead for this rule"""
+
+    def __init__(self, required=False, messages=None):
+        self.required = required
+        self.messages = messages or {}
+
+    def message(self, template):
+        return self.messages.get(template, template)
+
+    def compile(self):
+        """Returns a function ``check(value, errors)`` that appends a
+        `ValidationError` to ``errors`` for each problem"""
+        compiler = _Compiler()
+        compiler.line(0, 'def check(value, errors):')
+        self.emit(compiler, 'value', [], 1)
+        return compiler.function('check')
+
+    def emit(self, c, var, path, indent):
+        """Adds the code checking the variable ``var`` to ``c``.
+        ``path`` is a list of Python expressions for the path of the
+        value."""
+        raise NotImplementedError
+
+
+class String(Rule):
+    """A string, optionally non-empty, no longer than ``max_length``,
+    and passing ``test`` (or else getting the ``test_message``
+    error)"""
+
+    def __init__(self, required=False, non_empty=False, max_length=None,
+                 test=None, test_message=None, messages=None):
+        super(String, self).__init__(required, messages)
+        self.non_empty = non_empty
+        self.max_length = max_length
+        self.test = test
+        self.test_message = test_message
+
+    def emit(self, c, var, path, indent):
+        c.line(indent, 'if not isinstance(%s, basestring):' % var)
+        c.error(indent + 1, self.message(WRONG_TYPE), path, var,
+                kind='a string')
+        if self.non_empty:
+            c.line(indent, 'elif not %s:' % var)
+            c.error(indent + 1, self.message(EMPTY), path, var)
+        if self.max_length is not None:
+            c.line(indent, 'elif len(%s) > %s:' % (var, self.max_length))
+            c.error(indent + 1, self.message(TOO_LONG), path, var,
+                    max_length=self.max_length,
+                    length=c.expr('len(%s)' % var))
+        if self.test is not None:
+            c.line(indent, 'elif not %s(%s):' % (c.constant(self.test), var))
+            c.error(indent + 1, self.test_message, path, var)
+
+
+class Integer(Rule):
+    """An integer from ``min`` to ``max``"""
+
+    def __init__(self, required=False, min=None, max=None, messages=None):
+        super(Integer, self).__init__(required, messages)
+        self.min = min
+        self.max = max
 
-def is_string(o):
-    return isinstance(o, basestring)
+    def emit(self, c, var, path, indent):
+        c.line(indent, 'if not isinstance(%s, (int, long)) '
+               'or isinstance(%s, bool):' % (var, var))
+        c.error(indent + 1, self.message(WRONG_TYPE), path, var,
+                kind='an integer')
+        tests = []
+        if self.min is not None:
+            tests.append('%s < %r' % (var, self.min))
+        if self.max is not None:
+            tests.append('%s > %r' % (var, self.max))
+        if tests:
+            c.line(indent, 'elif %s:' % ' or '.join(tests))
+            c.error(indent + 1, self.message(OUT_OF_RANGE), path, var,
+                    min=self.min, max=self.max)
 
 
-def is_dict(o):
-    return isinstance(o, dict)
+class Object(Rule):
+    """An object with the given ``fields`` (a list of ``(key,
+    rule)``), whose other values all pass the ``values`` rule if
+    given.  Unless ``extra`` is true there can't be other keys."""
 
+    def __init__(self, required=False, fields=(), values=None, extra=True,
+                 messages=None):
+        super(Object, self).__init__(required, messages)
+        self.fields = fields
+        self.values = values
+        self.extra = extra
+
+    def emit(self, c, var, path, indent):
+        c.line(indent, 'if not isinstance(%s, dict):' % var)
+        c.error(indent + 1, self.message(WRONG_TYPE), path, var,
+                kind='an object')
+        if not self.fields and self.values is None and self.extra:
+            return
+        c.line(indent, 'else:')
+        indent += 1
+        known = c.constant(frozenset(key for key, rule in self.fields))
+        for key, rule in self.fields:
+            field_path = path + [repr(key)]
+            c.line(indent, 'if %r in %s:' % (key, var))
+            field_var = c.variable()
+            c.line(indent + 1, '%s = %s[%r]' % (field_var, var, key))
+            rule.emit(c, field_var, field_path, indent + 1)
+            if rule.required:
+                c.line(indent, 'else:')
+                c.error(indent + 1, rule.message(REQUIRED), field_path,
+                        'None')
+        if self.values is not None:
+            key_var = c.variable()
+            value_var = c.variable()
+            c.line(indent, 'for %s in sorted(%s):' % (key_var, var))
+            c.line(indent + 1, 'if %s not in %s:' % (key_var, known))
+            c.line(indent + 2, '%s = %s[%s]' % (value_var, var, key_var))
+            self.values.emit(c, value_var, path + [key_var], indent + 2)
+        if not self.extra:
+            unknown = c.variable()
+            c.line(indent, '%s = [key for key in %s if key not in %s]'
+                   % (unknown, var, known))
+            c.line(indent, 'if %s:' % unknown)
+            c.error(indent + 1, self.message(EXTRA_KEYS), path, var,
+                    keys=c.expr("', '.join(sorted(%s))" % unknown))
+
+
+class List(Rule):
+    """A list whose items all pass the ``items`` rule"""
+
+    def __init__(self, required=False, items=None, messages=None):
+        super(List, self).__init__(required, messages)
+        self.items = items
+
+    def emit(self, c, var, path, indent):
+        c.line(indent, 'if not isinstance(%s, (list, tuple)):' % var)
+        c.error(indent + 1, self.message(WRONG_TYPE), path, var,
+                kind='a list')
+        if self.items is not None:
+            index_var = c.variable()
+            item_var = c.variable()
+            c.line(indent, 'else:')
+            c.line(indent + 1, 'for %s, %s in enumerate(%s):'
+                   % (index_var, item_var, var))
+            self.items.emit(c, item_var, path + [index_var], indent + 2)
+
+
+class _Expression(str):
+    """Code to include as-is by `_Compiler.error`"""
+
+
+class _Compiler(object):
+    """Collects the generated code and the objects it uses"""
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = dict(ValidationError=ValidationError)
+        self.count = 0
+
+    def line(self, indent, code):
+        self.lines.append('    ' * indent + code)
+
+    def variable(self):
+        self.count += 1
+        return '_v%s' % self.count
+
+    def constant(self, value):
+        """Returns a name that refers to ``value`` in the code"""
+        name = self.variable()
+        self.namespace[name] = value
+        return name
+
+    def expr(self, code):
+        return _Expression(code)
+
+    def error(self, indent, template, path, var, **params):
+        args = [repr(template), _path_code(path), var]
+        for name, value in sorted(params.items()):
+            if not isinstance(value, _Expression):
+                value = repr(value)
+            args.append('%s=%s' % (name, value))
+        self.line(indent, 'errors.append(ValidationError(%s))'
+                  % ', '.join(args))
+
+    def function(self, name):
+        self.source = '\n'.join(self.lines) + '\n'
+        code = compile(self.source, '<validator>', 'exec')
+        exec code in self.namespace
+        func = self.namespace[name]
+        func.source = self.source
+        return func
+
+
+def _path_code(path):
+    if not path:
+        return '()'
+    return '(%s,)' % ', '.join(path)
+
+
+## A bunch of helpers:
 
 def is_path(s):
     if not s.startswith('/'):
@@ -172,9 +308,65 @@ def is_origin_match(s):
     return True
 
 
-def extra_keys(d, allowed):
-    extra = []
-    for key in sorted(d):
-        if key not in allowed:
-            extra.append(key)
-    return extra
+manifest_schema = Object(fields=[
+    ('capabilities', Object()),
+    ## FIXME: should test that it's a valid locale
+    ('default_locale', String(non_empty=True)),
+    ('experimental', Object()),
+    ('description', String(non_empty=True, max_length=1024,
+                           messages={EMPTY: EMPTY_IF_PRESENT})),
+    ('developer', Object(fields=[
+        ('name', String()),
+        ('url', String()),
+        ], extra=False)),
+    ('icons', Object(
+        values=String(non_empty=True, messages={
+            WRONG_TYPE: THE_WRONG_TYPE, EMPTY: IS_EMPTY}),
+        messages={WRONG_TYPE: THE_WRONG_TYPE})),
+    ('installs_allowed_from', List(
+        items=String(test=is_origin_match,
+                     test_message=NOT_AN_ORIGIN_MATCH,
+                     messages={WRONG_TYPE: ITEM_WRONG_TYPE}),
+        messages={WRONG_TYPE: THE_WRONG_TYPE})),
+    ('launch_path', String(test=is_path, test_message=NOT_A_PATH)),
+    ('name', String(required=True, non_empty=True)),
+    ('version', String(messages={WRONG_TYPE: THE_WRONG_TYPE})),
+    ('widget', Object(fields=[
+        ('path', String(required=True, test=is_path,
+                        test_message=NOT_A_VALID_PATH,
+                        messages={REQUIRED: MISSING,
+                                  WRONG_TYPE: THE_WRONG_TYPE})),
+        ('width', Integer(min=10, max=1000, messages={
+            WRONG_TYPE: THE_WRONG_TYPE, OUT_OF_RANGE: NOT_IN_RANGE})),
+        ('height', Integer(min=10, max=1000, messages={
+            WRONG_TYPE: THE_WRONG_TYPE, OUT_OF_RANGE: NOT_IN_RANGE})),
+        ], messages={WRONG_TYPE: THE_WRONG_TYPE})),
+    ])
+
+_check_manifest = manifest_schema.compile()
+
+
+def validate(manifest):
+    """Validates a manifest and returns a list of `ValidationError`
+    (empty if the manifest is valid)"""
+    errors = []
+    if not isinstance(manifest, dict):
+        errors.append(ValidationError(NOT_AN_OBJECT, (), manifest))
+    else:
+        _check_manifest(manifest, errors)
+    return errors
+
+
+def validate_many(manifests):
+    """Validates several manifests, returning a list with the errors
+    for each manifest in the same order"""
+    check = _check_manifest
+    results = []
+    for manifest in manifests:
+        errors = []
+        if not isinstance(manifest, dict):
+            errors.append(ValidationError(NOT_AN_OBJECT, (), manifest))
+        else:
+            check(manifest, errors)
+        results.append(errors)
+    return results
@@ -1,18 +1,34 @@
 import os
+import urllib
 import urlparse
-import codecs
 from webob.dec import wsgify
 from webob import exc
 from webob import Response
 from routes import Mapper, URLGenerator
 from directory import model
-from directory import validator
-from directory.util import get_origin, format_description, clean_unicode
+from directory.util import get_origin, format_description
 from directory.util import make_slug, get_template_search_paths, json
-from directory import httpget
+from directory import importer
+from directory import builder
+from directory import cache
+from directory import icons
+from directory.cache import LRUCache
+from directory.snapshot import SnapshotCache
 import jinja2
 from datetime import datetime
-import dateutil
+import time
+import dateutil.parser
+from webob.datetime_utils import UTC, serialize_date
+from webob.etag import NoETag
+
+
+## Rendered application boxes, shared by all WSGIApps in the process:
+fragment_cache = LRUCache(max_size=2000)
+
+## Applications per response from /api/apps, and the most a client
+## can ask for with ``limit``:
+api_page_size = 100
+api_max_page_size = 500
 
 
 class WSGIApp(object):
@@ -20,40 +36,97 @@ class WSGIApp(object):
     map = Mapper()
     map.connect('home', '/', method='index')
     map.connect('add', '/add', method='add')
+    map.connect('add_status', '/add/status/{job_id}', method='add_status')
     map.connect('build', '/build', method='build')
     map.connect('view_app', '/app/{origin}/{slug}', method='view_app')
     map.connect('about', '/about', method='about')
     map.connect('search', '/search', method='search')
+    map.connect('all_apps', '/apps', method='all_apps')
     map.connect('keyword', '/keyword/{keyword}', method='view_keywords')
     map.connect('keywords', '/keyword/', method='all_keywords')
     map.connect('admin_app', '/app/{origin}/{slug}/admin', method='admin_app')
     map.connect('keyword_admin', '/admin/keywords', method='admin_keywords')
+    map.connect('admin_stats', '/admin/stats', method='admin_stats')
+    map.connect('api_apps', '/api/apps', method='api_apps')
 
     def __init__(self, db, search_paths=None,
                  site_title=None,
-                 jsapi_location=None):
-        self.setup_db(db)
+                 jsapi_location=None,
+                 page_size=20,
+                 production=False,
+                 template_cache_dir=None,
+                 async_add=False,
+                 icon_dir=None,
+                 snapshot=False,
+                 replica_dbs=(),
+                 read_your_writes=10,
+                 db_options=None):
+        self.setup_db(db, replica_dbs, db_options)
+        ## After a client changes something, its reads go to the
+        ## primary database for this many seconds, until the
+        ## replicas have caught up:
+        self.read_your_writes = read_your_writes
         if not search_paths:
             search_paths = get_template_search_paths(search_paths)
+        self.search_paths = tuple(search_paths)
+        self.production = production
+        self.setup_templates(search_paths, template_cache_dir)
+        self.site_title = site_title or 'Application Directory'
+        self.jsapi_location = jsapi_location or 'https://myapps.mozillalabs.com'
+        self.page_size = int(page_size)
+        ## Submissions are queued for ``directory worker``:
+        self.async_add = async_add
+        if icon_dir:
+            ## Icons are mirrored here, and served by configure.make_app:
+            icons.icon_dir = icon_dir
+        ## Read-only pages are served from memory (see directory.snapshot):
+        self.snapshots = None
+        if snapshot:
+            self.snapshots = SnapshotCache()
+
+    def setup_templates(self, search_paths, template_cache_dir=None):
+        """Sets up the Jinja environment.
+
+        In production mode templates are never reloaded, their
+        compiled code is shared between processes through
+        ``template_cache_dir`` (the temp directory if not given), and
+        they are all compiled right away."""
         self.jinja_loader = jinja2.FileSystemLoader(search_paths)
+        kw = {}
+        if self.production:
+            if template_cache_dir and not os.path.exists(template_cache_dir):
+                os.makedirs(template_cache_dir)
+            kw['bytecode_cache'] = jinja2.FileSystemBytecodeCache(
+                template_cache_dir, '__directory_jinja2_%s.cache')
+            ## Keep every template once loaded:
+            kw['cache_size'] = -1
         self.jinja_env = jinja2.Environment(
             trim_blocks=True,
             autoescape=True,
             loader=self.jinja_loader,
-            auto_reload=True,
-            )
-        self.site_title = site_title or 'Application Directory'
-        self.jsapi_location = jsapi_location or 'https://myapps.mozillalabs.com'
+            auto_reload=not self.production,
+            **kw)
+        ## Per-request helpers are added in Handler.render:
+        self.jinja_env.globals.update(dict(
+            app_config=self,
+            sorted=sorted,
+            isinstance=isinstance,
+            list=list,
+            format_description=format_description))
+        if self.production:
+            for name in self.jinja_loader.list_templates():
+                if (not name.startswith('static/')
+                    and os.path.splitext(name)[1] in ('.html', '.txt')):
+                    self.jinja_env.get_template(name)
 
-    def setup_db(self, db):
+    def setup_db(self, db, replica_dbs=(), db_options=None):
+        """Connects to the database; ``db_options`` are passed to
+        `model.create_engine`"""
         self.db = db
-        from sqlalchemy import create_engine
-        kw = {}
-        if self.db.startswith('mysql:'):
-            kw['pool_recycle'] = 3600
-        self.engine = create_engine(self.db, **kw)
-        model.Session.configure(bind=self.engine)
-        model.Base.metadata.create_all(self.engine)
+        self.replica_dbs = tuple(replica_dbs)
+        self.db_options = db_options or {}
+        self.engine = model.connect(self.db, self.replica_dbs,
+                                    **self.db_options)
 
     @wsgify
     def __call__(self, req):
@@ -75,46 +148,128 @@ class Handler(object):
         self.link = link
         self.match = match
         self._session = None
+        self._read_session = None
+        ## Headers for the response, set by check_modified:
+        self.response_headers = []
+        ## True if this client should see a change on its next pages
+        ## (always so after a POST):
+        self.wrote = False
 
     @property
     def session(self):
+        """The primary database session, which is the same one model
+        queries use when not given a session (`model.Session`)"""
         if self._session is None:
             self._session = model.Session()
         return self._session
 
+    @property
+    def read_session(self):
+        """A session for pages that only read, which uses a replica
+        database unless this client changed something recently"""
+        if self._read_session is None:
+            if self.wrote_recently():
+                self._read_session = self.session
+            else:
+                self._read_session = model.read_session()
+        return self._read_session
+
+    write_cookie = 'directory_wrote'
+
+    def wrote_recently(self):
+        try:
+            wrote = int(self.req.cookies.get(self.write_cookie, 0))
+        except ValueError:
+            return False
+        return time.time() - wrote < self.app.read_your_writes
+
     def respond(self):
         kwargs = self.match.copy()
         method = kwargs.pop('method')
         method = getattr(self, method)
         try:
-            result = method(**kwargs)
-        except:
-            if self._session:
-                self._session.rollback()
-            raise
-        else:
-            if self._session:
-                self._session.commit()
+            try:
+                result = method(**kwargs)
+            except:
+                if self._session:
+                    self._session.rollback()
+                raise
+            else:
+                if self._session and self.has_writes():
+                    self._session.commit()
+        finally:
+            if (self._read_session is not None
+                and self._read_session is not self._session):
+                self._read_session.close()
+            ## Closes the session the views and model queries shared,
+            ## returning its connection to the pool:
+            model.Session.remove()
+        wrote = self.wrote or self.req.method == 'POST'
+        if wrote and self.app.snapshots is not None:
+            ## Show any change on the next page:
+            self.app.snapshots.invalidate()
+        if wrote and self._session is not None and self.app.replica_dbs:
+            ## So this client's reads see the change (see read_session):
+            self.response_headers.append((
+                'Set-Cookie', '%s=%d; Max-Age=%d; Path=/' % (
+                    self.write_cookie, time.time(),
+                    self.app.read_your_writes)))
+        if self.response_headers:
+            if isinstance(result, basestring):
+                result = Response(result)
+            result.headers.extend(self.response_headers)
         return result
 
+    def has_writes(self):
+        """True if the request may have changed something that needs
+        committing; pages that only read skip the commit"""
+        session = self._session
+        return (self.req.method not in ('GET', 'HEAD')
+                or bool(session.new or session.dirty or session.deleted))
+
+    def check_modified(self, etag, last_modified=None, admin_aware=False):
+        """Sets the ETag (and optionally Last-Modified) of the response,
+        and raises 304 Not Modified if the client already has it.
+
+        Call this before doing any real work.  If the page looks
+        different for admins, pass ``admin_aware`` so the response
+        varies on the login cookie."""
+        if admin_aware:
+            etag += self.is_admin() and '-admin' or '-anon'
+        headers = [('ETag', '"%s"' % etag)]
+        if last_modified is not None:
+            ## Dates are stored in local time, but HTTP wants UTC:
+            last_modified = datetime.fromtimestamp(
+                int(time.mktime(last_modified.timetuple())), UTC)
+            headers.append(('Last-Modified', serialize_date(last_modified)))
+        if admin_aware:
+            headers.append(('Vary', 'Cookie'))
+        self.response_headers.extend(headers)
+        if self.req.method not in ('GET', 'HEAD'):
+            return
+        if self.req.if_none_match is not NoETag:
+            not_modified = etag in self.req.if_none_match
+        else:
+            since = self.req.if_modified_since
+            not_modified = (since is not None and last_modified is not None
+                            and last_modified <= since)
+        if not_modified:
+            raise exc.HTTPNotModified(headers=headers)
+
     def render(self, template_name, **args):
         template_class = make_slug(template_name)
         if not os.path.splitext(template_name)[1]:
             template_name += '.html'
-        tmpl = self.app.jinja_env.get_template(
-            template_name,
-            globals=dict(
-                req=self.req,
-                handler=self,
-                app_config=self.app,
-                sorted=sorted,
-                isinstance=isinstance,
-                list=list,
-                app_html=self.app_html,
-                format_description=format_description,
-                template_class=template_class,
-                format_date=self.format_date))
-        return tmpl.render(**args)
+        tmpl = self.app.jinja_env.get_template(template_name)
+        context = dict(
+            req=self.req,
+            handler=self,
+            app_html=self.app_html,
+            page_url=self.page_url,
+            template_class=template_class,
+            format_date=self.format_date)
+        context.update(args)
+        return tmpl.render(context)
 
     def get_app(self, origin_key, session=None):
         app = model.Application.get(origin_key, session=session)
@@ -123,7 +278,51 @@ class Handler(object):
         return app
 
     def app_html(self, app, **options):
-        return jinja2.Markup(self.render('one_app', app=app, **options))
+        """Renders an application box (``one_app.html``).
+
+        The box only depends on the application and ``options``, so
+        it is cached until the application changes.  Each commit that
+        changes the application gives it a new ``change_seq``, so
+        changes made by other processes are seen too."""
+        if app.id is None:
+            return jinja2.Markup(self.render('one_app', app=app, **options))
+        ## Application ids are only unique in one database:
+        key = (self.app.search_paths, self.app.db, app.id, app.change_seq,
+               cache.app_version(app.id), app.last_updated or app.added,
+               tuple(sorted(options.items())))
+        html = fragment_cache.get(key)
+        if html is None:
+            html = jinja2.Markup(self.render('one_app', app=app, **options))
+            fragment_cache.set(key, html)
+        return html
+
+    def page_args(self):
+        """The ``after``/``before`` arguments for a paginated query"""
+        return dict(after=self.req.GET.get('after') or None,
+                    before=self.req.GET.get('before') or None)
+
+    def get_page(self, func, *args):
+        """Calls a paginated model query (like `Application.search_page`)
+        with the page requested in this request"""
+        try:
+            return func(*args, page_size=self.app.page_size,
+                        **self.page_args())
+        except ValueError, e:
+            raise exc.HTTPBadRequest(str(e))
+
+    def page_url(self, after=None, before=None):
+        """The URL of this page, but for a different page of results"""
+        params = [(name, value) for name, value in self.req.GET.items()
+                  if name not in ('after', 'before')]
+        if after:
+            params.append(('after', after))
+        if before:
+            params.append(('before', before))
+        url = self.req.path_url
+        if params:
+            url += '?' + urllib.urlencode(
+                [(name, value.encode('utf8')) for name, value in params])
+        return url
 
     def is_admin(self):
         return bool(self.req.environ.get('x-wsgiorg.developer_user'))
@@ -135,12 +334,32 @@ class Handler(object):
 
     ## Actual views:
 
+    def catalog(self):
+        """What the read-only pages get the catalog from: the
+        `directory.snapshot.Snapshot` if the site keeps one, or else
+        a `model.Catalog` using `read_session`"""
+        if self.app.snapshots is not None:
+            return self.app.snapshots.get()
+        return model.Catalog(self.read_session)
+
+    def catalog_etag(self):
+        generation, changed = self.catalog().state()
+        return 'catalog-%s' % generation, changed
+
     def index(self):
-        featured_apps = model.Application.featured_apps().all()
-        keywords = [k.word for k in model.Keyword.all_words()]
-        recent_apps = model.Application.recent(6).all()
+        catalog = self.catalog()
+        featured_apps = catalog.featured_apps()
+        etag, changed = self.catalog_etag()
+        ## The featured apps can change with no change to the catalog:
+        etag += '-' + '.'.join(str(app.id) for app in featured_apps)
+        self.check_modified(etag, admin_aware=True)
+        keyword_counts = catalog.all_word_counts()
+        recent_apps = catalog.recent(6)
+        keywords = [word for word, count in keyword_counts]
         return self.render('index', featured_apps=featured_apps,
-                           keywords=keywords, recent_apps=recent_apps)
+                           keywords=keywords,
+                           keyword_counts=dict(keyword_counts),
+                           recent_apps=recent_apps)
 
     def add(self):
         errors = {}
@@ -166,103 +385,123 @@ class Handler(object):
 
     def _add_application(self):
         url = self.req.params['manifest_url']
+        if self.app.async_add and not self.req.params.get('dontadd'):
+            ## If this was just checked with dontadd, the worker uses
+            ## the copy that was checked:
+            fetched = None
+            if not self._wants_fresh():
+                entry = importer.fetched_manifests.get(url)
+                if entry is not None:
+                    fetched = entry[:2]
+            job = model.AddJob.submit(url, session=self.session,
+                                      fetched=fetched)
+            self.session.commit()
+            return None, None, self._job_response(job)
         manifest, raw_data, errors = self._get_manifest(url)
         if errors:
-            errors['url'] = url
-            errors['raw_data'] = raw_data
-            errors['manifest'] = manifest
-            extra_errors = []
-            errors = clean_unicode(errors, extra_errors.append)
-            if extra_errors:
-                errors['unicode'] = extra_errors
+            errors = importer.annotate_errors(errors, url, manifest, raw_data)
             return None, errors, None
-        if not errors:
-            origin = get_origin(url)
-            app = model.Application.by_origin(origin, session=self.session)
-            if self.req.params.get('dontadd'):
-                if app is None:
-                    check_message = 'Your new application is ready and valid!'
-                else:
-                    check_message = 'Your application update is ready and valid!'
-                return check_message, errors, None
+        if self.req.params.get('dontadd'):
+            app = model.Application.by_origin(get_origin(url),
+                                              session=self.session)
             if app is None:
-                app = model.Application.from_manifest(
-                    manifest, datetime.now(), url, origin,
-                    session=self.session)
+                check_message = 'Your new application is ready and valid!'
             else:
-                app.update_from_manifest(
-                    manifest, datetime.now(), url, origin,
-                    session=self.session)
-            url = urlparse.urljoin(self.req.url, app.url)
-            resp = Response(
-                url, location=app.url, status=302,
-                content_type='text/plain')
-            return None, None, resp
+                check_message = 'Your application update is ready and valid!'
+            return check_message, errors, None
+        app = importer.save_manifest(manifest, url, self.session)
+        self.session.commit()
+        if app.featured:
+            model.featured_cache.invalidate()
+        ## The icon is mirrored later (by ``directory mirror-icons``),
+        ## not while the client waits:
+        return None, None, self._app_added(app.url)
+
+    def _app_added(self, app_url):
+        url = urlparse.urljoin(self.req.url, app_url)
+        return Response(
+            url, location=app_url, status=302,
+            content_type='text/plain')
+
+    def _job_response(self, job):
+        """202 Accepted, pointing to the status of a queued submission"""
+        status_url = '/add/status/%s' % job.id
+        if 'text/html' in self.req.accept:
+            resp = Response(self.render('add_status', job=job))
+            ## Browsers poll the job status until it is done:
+            resp.headers['Refresh'] = '2; url=%s' % status_url
+        else:
+            resp = Response(urlparse.urljoin(self.req.url, status_url),
+                            content_type='text/plain')
+        resp.status = 202
+        resp.location = status_url
+        resp.headers['Retry-After'] = '2'
+        resp.cache_control = 'no-cache'
+        return resp
+
+    def add_status(self, job_id):
+        job = None
+        if job_id.isdigit():
+            job = self.session.query(model.AddJob).get(int(job_id))
+        if job is None:
+            raise exc.HTTPNotFound('No such submission')
+        if job.state == 'done':
+            ## The worker added it after the POST, so the client has to
+            ## read its own write from here on:
+            self.wrote = True
+            return self._app_added(job.app_url)
+        if job.state == 'failed':
+            if 'text/html' not in self.req.accept:
+                return Response(
+                    self.render('errors.txt', errors=job.errors),
+                    content_type='text/plain',
+                    status=400)
+            return self.render('add', errors=job.errors, check_message=None)
+        return self._job_response(job)
 
     def _get_manifest(self, manifest_url):
-        errors = {}
-        content_type, raw_data = httpget.get(manifest_url)
-        if content_type != validator.content_type:
-            errors['content_type'] = content_type
-            errors['content_type_wanted'] = validator.content_type
-        ## FIXME: should try to figure out the encoding better
-        if raw_data.startswith(codecs.BOM_UTF8):
-            raw_data = raw_data[len(codecs.BOM_UTF8):]
-        try:
-            raw_data = raw_data.decode('utf8')
-        except UnicodeDecodeError, e:
-            errors['unicode'] = e
-            raw_data = raw_data.decode('utf8', 'replace')
-        manifest = None
-        try:
-            manifest = json.loads(raw_data.strip())
-        except Exception, e:
-            errors['json_parse'] = unicode(e)
-        if manifest:
-            error_log = validator.validate(manifest)
-            if error_log:
-                errors['error_log'] = error_log
-        return manifest, raw_data, errors
+        """Fetches a manifest, reusing one fetched moments ago unless
+        the client asks for a fresh copy"""
+        return importer.fetch_manifest(manifest_url,
+                                       use_cache=not self._wants_fresh())
+
+    def _wants_fresh(self):
+        """True if the client asked us not to use a cached copy (with
+        ``refetch=1`` or ``Cache-Control: no-cache``)"""
+        return bool(self.req.params.get('refetch')
+                    or 'no-cache' in self.req.headers.get('Cache-Control', '')
+                    or 'no-cache' in self.req.headers.get('Pragma', ''))
 
     def build(self):
         p = self.req.params
-        manifest = None
-        if 'url' in p and 'has_manifest' not in p:
-            manifest = self._guess_manifest(p['url'])
+        manifest = error = None
+        if p.get('url') and 'has_manifest' not in p:
+            url = p['url']
+            if not urlparse.urlsplit(url).scheme:
+                url = 'http://' + url
+            try:
+                manifest = builder.guess_manifest(
+                    url, use_cache=not self._wants_fresh())
+            except IOError, e:
+                error = str(e) or e.__class__.__name__
         elif 'has_manifest' in p:
             pass
-        return self.render('build', manifest=manifest)
-
-    def _guess_manifest(self, url):
-        import lxml.html
-        page = lxml.html.parse(url)
-        name = page.cssselect('title')
-        if name:
-            name = name[0].text_content()
-        else:
-            name = 'unknown'
-        keywords = page.cssselect('meta[name=keywords]')
-        if keywords:
-            keywords = [k.strip() for k in keywords.get('content', '').split(',')]
-        else:
-            keywords = []
-        desc = page.cssselect('meta[name=description]')
-        if desc:
-            desc = desc.get('content').strip()
-        else:
-            desc = ''
-        ## FIXME: get favicon
-        manifest = {
-            'name': name,
-            'description': desc,
-            'launch_path': urlparse.urlsplit(url).path,
-            'icons': {},
-            'experimental': {'keywords': keywords},
-            }
-        return manifest
+        return self.render(
+            'build', manifest=manifest, error=error, url=p.get('url', ''),
+            manifest_json=manifest and json.dumps(manifest, indent=2))
 
     def view_app(self, origin, slug):
-        app = self.get_app(origin)
+        catalog = self.catalog()
+        modified = catalog.modified(origin)
+        if modified is None:
+            raise exc.HTTPNotFound('No such application')
+        app_id, last_modified = modified
+        self.check_modified(
+            'app-%s-%s' % (app_id, last_modified.strftime('%Y%m%d%H%M%S%f')),
+            last_modified, admin_aware=True)
+        app = catalog.get(origin)
+        if app is None:
+            raise exc.HTTPNotFound('No such application')
         return self.render('view_app', app=app)
 
     def admin_app(self, origin, slug):
@@ -272,8 +511,13 @@ class Handler(object):
         if self.req.method == 'POST':
             p = self.req.params
             if p.get('delete'):
+                ## This also removes the app from the search index:
                 self.session.delete(app)
+                ## So /api/apps clients delete it too:
+                self.session.add(model.AppDeletion(app.origin))
                 self.session.commit()
+                model.featured_cache.invalidate()
+                cache.invalidate_app(app.id)
                 return 'Deleted!'
             app.featured = bool(p.get('featured'))
             if p.get('featured_sort'):
@@ -281,20 +525,23 @@ class Handler(object):
             else:
                 app.featured_sort = None
             if p.get('featured_start'):
-                app.featured_start = dateutil.parse(p['featured_start'])
+                app.featured_start = dateutil.parser.parse(p['featured_start'])
             else:
                 app.featured_start = None
             if p.get('featured_end'):
-                app.featured_end = dateutil.parse(p['featured_end'])
+                app.featured_end = dateutil.parser.parse(p['featured_end'])
             else:
                 app.featured_end = None
             keywords = p.get('keywords') or ''
             keywords = [k.strip() for k in keywords.split(',')
                         if k.strip()]
             app.keywords = keywords
+            app.update_search_terms()
             model.Keyword.add_words(keywords, session=self.session)
             self.session.add(app)
             self.session.commit()
+            model.featured_cache.invalidate()
+            cache.invalidate_app(app.id)
             return exc.HTTPFound(app.url + '/admin')
         return self.render('admin_app', app=app)
 
@@ -304,6 +551,7 @@ class Handler(object):
         s = self.session
         keywords = s.query(model.Keyword).order_by(model.Keyword.word).all()
         trimmed = None
+        dry_run = False
         by_word = dict(
             (k.word, k) for k in keywords)
         if self.req.method == 'POST':
@@ -320,30 +568,118 @@ class Handler(object):
             for k in keywords:
                 s.add(k)
             if self.req.params.get('trim'):
-                trimmed = model.Keyword.trim_keywords(self.session)
+                dry_run = bool(self.req.params.get('dry_run'))
+                trimmed = model.Keyword.trim_keywords(
+                    self.session, dry_run=dry_run)
             s.commit()
         return self.render('admin_keywords', keywords=keywords,
-                           trimmed=trimmed)
+                           trimmed=trimmed, dry_run=dry_run)
+
+    def admin_stats(self):
+        if not self.is_admin():
+            raise exc.HTTPNotFound
+        lines = []
+        for name, stats in sorted(self.stats().items()):
+            for key, value in sorted(stats.items()):
+                lines.append('%s.%s: %s' % (name, key, value))
+        return Response('\n'.join(lines) + '\n', content_type='text/plain')
+
+    def stats(self):
+        """Returns ``{name: {counter: value}}`` for the caches and other
+        things worth watching"""
+        stats = dict(fragment_cache=fragment_cache.stats(),
+                     manifest_cache=importer.fetched_manifests.stats(),
+                     build_cache=builder.guessed_manifests.stats())
+        if self.app.snapshots is not None:
+            stats['snapshot'] = self.app.snapshots.stats()
+        if model.replicas is not None:
+            stats['replicas'] = model.replicas.stats()
+        stats['db_pool'] = model.pool_counter.stats()
+        return stats
+
+    def api_apps(self):
+        """The catalog as JSON, for mirrors and other clients that
+        keep a copy of it.
+
+        Without ``since`` this lists every application; otherwise only
+        what changed after ``since`` is listed.  Either way the
+        response has at most ``limit`` changes, with the ``since`` to
+        use next time in ``next`` (``more`` says if there are more
+        right now).  Clients polling with the ETag get a 304 until
+        something in the catalog changes."""
+        since = self.req.GET.get('since') or None
+        try:
+            limit = max(1, min(int(self.req.GET.get('limit') or api_page_size),
+                               api_max_page_size))
+            if since is not None:
+                model.decode_change_key(since)
+                since = str(since)
+        except (ValueError, UnicodeError), e:
+            raise exc.HTTPBadRequest(str(e))
+        generation, changed = model.CatalogState.current(
+            session=self.read_session)
+        self.check_modified('apps-%s-%s-%s' % (generation, limit, since or ''))
+        changes = model.Application.changes(
+            since=since, limit=limit, session=self.read_session)
+        ## Serialized now, as the applications are expired on commit:
+        apps = [self._app_data(app) for app in changes.apps]
+        deleted = [dict(origin=d.origin, deleted=d.deleted.isoformat())
+                   for d in changes.deleted]
+        tail = dict(deleted=deleted, next=changes.next_key, more=changes.more)
+        resp = Response(content_type='application/json',
+                        app_iter=self._stream_json(apps, tail))
+        if changes.more:
+            resp.headers['Link'] = '<%s?%s>; rel="next"' % (
+                self.req.path_url, urllib.urlencode(
+                    [('since', changes.next_key), ('limit', limit)]))
+        return resp
+
+    def _app_data(self, app):
+        return dict(
+            origin=app.origin,
+            name=app.name,
+            description=app.description,
+            url=self.req.host_url + app.url,
+            manifest_url=app.manifest_url,
+            manifest=app.manifest,
+            icon_url=app.icon_url,
+            keywords=app.keywords,
+            added=app.added.isoformat(),
+            last_updated=app.last_updated.isoformat())
+
+    def _stream_json(self, apps, tail):
+        """Writes ``{"apps": [...], ...tail}`` an application at a time"""
+        yield '{"apps": ['
+        for i, app in enumerate(apps):
+            yield (i and ',\n' or '\n') + json.dumps(app)
+        yield '],\n' + json.dumps(tail)[1:] + '\n'
 
     def search(self):
         q = self.req.GET.get('q')
         if q:
-            results = model.Application.search(q).all()
+            results = self.get_page(self.catalog().search_page, q)
         else:
             results = None
         return self.render('search', results=results, q=q)
 
+    def all_apps(self):
+        apps = self.get_page(self.catalog().all_apps_page)
+        return self.render('all_apps', apps=apps)
+
     def view_keywords(self, keyword):
-        apps = model.Application.search_keyword(keyword)
-        k = model.Keyword.get(keyword)
+        self.check_modified(*self.catalog_etag())
+        catalog = self.catalog()
+        k = catalog.get_keyword(keyword)
         if k is None:
             # This doesn't exist
             return exc.HTTPNotFound('No keyword found')
+        apps = self.get_page(catalog.search_keyword_page, keyword)
         return self.render('view_keywords', apps=apps, keyword=keyword,
                            description=k.description)
 
     def all_keywords(self):
-        keywords = [k.word for k in model.Keyword.all_words()]
+        self.check_modified(*self.catalog_etag())
+        keywords = [k.word for k in self.catalog().all_words()]
         return self.render('all_keywords', keywords=keywords)
 
     def about(self):
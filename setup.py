@@ -27,5 +27,7 @@ This implements a simple directory of 'Open Web Applications'.
       entry_points="""
       [paste.app_factory]
       main = directory.configure:make_app
+      [console_scripts]
+      directory = directory.commands:main
       """,
       )